@@ -6,12 +6,18 @@ Oracle Module
 
 from __future__ import absolute_import, print_function, unicode_literals
 import logging
+import logging.handlers
 import sys
 import os
 from salt.ext import six
 from salt.utils.decorators import depends
+import salt.utils.files
+import salt.utils.json
+import salt.utils.stringutils
 import time
+import collections
 import re
+import csv
 import subprocess
 
 log = logging.getLogger(__name__)
@@ -22,6 +28,7 @@ try:
     import gevent
     from gevent import Greenlet
     import gevent.subprocess
+    from gevent.threadpool import ThreadPool
     HAS_CX_ORACLE = True
     authorization_modes = {"SYSASM": cx_Oracle.SYSASM, "SYSBKP": cx_Oracle.SYSBKP, "SYSDBA": cx_Oracle.SYSDBA, "SYSDGD": cx_Oracle.SYSDGD, "SYSKMT": cx_Oracle.SYSKMT, "SYSOPER": cx_Oracle.SYSOPER, "SYSRAC": cx_Oracle.SYSRAC, "PRELIM_AUTH": cx_Oracle.PRELIM_AUTH}
     rman_authorization_modes = {"SYSBKP": 'sysbackup', "SYSDBA": 'sysdba'}
@@ -55,12 +62,75 @@ def _is_oracle_home_set():
        return False
     return True
 
-def _connect(**kwargs):
+def _config(name, default=None):
+    '''
+    Return oracle.<name> from minion config or pillar
+    '''
+    val = __salt__['config.option']('oracle.{0}'.format(name), None)
+    if val is None:
+       val = __salt__['config.get']('oracle:{0}'.format(name), None)
+    return default if val is None else val
 
-    """ Connect to the oracle database. """
+def _get_pool(conn_args):
+    '''
+    Return the cx_Oracle session pool of (dsn, user, mode), created on first use
+    and kept in __context__ for the life of the minion process.
+
+    Pool can be tuned in the minion config:
+        oracle.pool_min: 0          minimum number of sessions
+        oracle.pool_max: 4          maximum number of sessions
+        oracle.pool_timeout: 300    seconds an idle session is kept open
+        oracle.pool_wait: 30        seconds to wait for a free session (cx_Oracle 6.4+)
+        oracle.stmtcachesize: 50    statements cached per session
+        oracle.pool: False          connect and close a session per call instead
+
+    A released session keeps its session state (NLS settings, current_schema,
+    package variables, ...). Sessions that ran an ALTER SESSION statement are
+    dropped from the pool instead of released, state set any other way (PL/SQL,
+    dbms_session) leaks to the next caller of the pool.
+    '''
+    pools = __context__.setdefault('devops_oracle.pools', {})
+    key = (conn_args['dsn'], conn_args['user'], conn_args.get('mode'))
+    if key not in pools:
+       pool = cx_Oracle.SessionPool(conn_args['user'], conn_args['pass'], conn_args['dsn'],
+                                    min=int(_config('pool_min', 0)),
+                                    max=int(_config('pool_max', 4)),
+                                    increment=1,
+                                    threaded=True,
+                                    # TIMEDWAIT is cx_Oracle 6.4+, older versions wait with no limit
+                                    getmode=getattr(cx_Oracle, 'SPOOL_ATTRVAL_TIMEDWAIT', cx_Oracle.SPOOL_ATTRVAL_WAIT))
+       pool.timeout = int(_config('pool_timeout', 300))
+       try:
+           pool.wait_timeout = int(_config('pool_wait', 30)) * 1000
+       except AttributeError:
+           pass
+       log.debug('Created session pool for %s@%s', conn_args['user'], conn_args['dsn'])
+       pools[key] = pool
+    return pools[key]
+
+def _acquire(pool, stmtcachesize):
+    '''
+    Acquire a healthy session from pool, a dead session is dropped and replaced once.
+    Only cx_Oracle objects are used, so it can run in a pool thread.
+    '''
+    conn = pool.acquire()
+    try:
+        conn.ping()
+    except cx_Oracle.DatabaseError as exc:
+        log.debug('Drop dead pooled session: %s', exc)
+        pool.drop(conn)
+        conn = pool.acquire()
+    conn.stmtcachesize = stmtcachesize
+    return conn
+
+def _connection_args(**kwargs):
+
+    """ Resolve the connection arguments (user, pass, dsn, mode) of the oracle database. """
 
     #connargs = dict()
     global connargs
+    # Work on a copy, so concurrent calls do not mix their arguments
+    conn_args = dict(connargs)
 
     def _connarg(name, key=None, get_opts=True):
         '''
@@ -89,7 +159,7 @@ def _connect(**kwargs):
            key = name
 
         if name in kwargs:
-           connargs[key] = kwargs[name]
+           conn_args[key] = kwargs[name]
         elif get_opts:
            prefix = 'connection_'
            if name.startswith(prefix):
@@ -102,7 +172,7 @@ def _connect(**kwargs):
                  __salt__['config.get']('oracle:{0}'.format(name), None) or \
                  __salt__['pillar.get']('oracle.{0}'.format(name), None)
            if val is not None:
-              connargs[key] = val
+              conn_args[key] = val
 
     get_opts = True
     _connarg('connection_host', 'host', get_opts)
@@ -113,14 +183,26 @@ def _connect(**kwargs):
     _connarg('connection_mode', 'mode', get_opts)
 
     #connargs['dsn'] = cx_Oracle.makedsn(host=connargs['host'], port=connargs['port'], sid=connargs['sid']).replace('SID','SERVICE_NAME')
-    connargs['dsn'] = '{0}:{1}/{2}'.format(connargs['host'], connargs['port'], connargs['sid'])
+    conn_args['dsn'] = '{0}:{1}/{2}'.format(conn_args['host'], conn_args['port'], conn_args['sid'])
+    return conn_args
+
+def _connect(**kwargs):
+
+    """ Connect to the oracle database. """
+
+    conn_args = _connection_args(**kwargs)
     try:
-        if connargs['mode'] is not None:
+        if conn_args.get('mode') is not None:
+           # Privileged (SYSDBA, PRELIM_AUTH, ...) sessions can not be pooled
            #conn = cx_Oracle.connect(user=connargs['user'], password=connargs['pass'], dsn=connargs['dsn'], mode=connargs['mode'])
-           conn = cx_Oracle.connect(connargs['user'], connargs['pass'], connargs['dsn'], mode=connargs['mode'])
+           conn = cx_Oracle.connect(conn_args['user'], conn_args['pass'], conn_args['dsn'], mode=conn_args['mode'])
+        elif _config('pool', True):
+           pool = _get_pool(conn_args)
+           conn = _acquire(pool, int(_config('stmtcachesize', 50)))
+           __context__.setdefault('devops_oracle.pooled', {})[id(conn)] = pool
         else:
            #conn = cx_Oracle.connect(user=connargs['user'], password=connargs['pass'], dsn=connargs['dsn'])
-           conn = cx_Oracle.connect(connargs['user'], connargs['pass'], connargs['dsn'])
+           conn = cx_Oracle.connect(conn_args['user'], conn_args['pass'], conn_args['dsn'])
     except cx_Oracle.DatabaseError as exc:
         err = 'Oracle Error {0}'.format(exc)
         __context__['devops_oracle.error'] = err
@@ -129,15 +211,21 @@ def _connect(**kwargs):
 
     return conn
 
-def _disconnect(conn):
+def _disconnect(conn, drop=False):
     """
-    Disconnect from the database. If this fails, for instance
-    if the connection instance doesn't exist, ignore the exception.
+    Disconnect from the database, a pooled session is released to its pool,
+    or closed and dropped from it if drop is True (session state was changed).
+    If this fails, for instance if the connection instance doesn't exist, ignore the exception.
     """
 
     try:
-        conn.cursor.close()
-        conn.db.close()
+        pool = __context__.get('devops_oracle.pooled', {}).pop(id(conn), None)
+        if pool is not None and drop:
+           pool.drop(conn)
+        elif pool is not None:
+           pool.release(conn)
+        else:
+           conn.close()
     except cx_Oracle.DatabaseError:
         pass
 
@@ -299,8 +387,126 @@ def startup(sid, force=False, restrict=False, pfile=None, connection_mode='SYSDB
     ret['result'] = True
     return ret
 
+def _parse_counts(cur):
+    '''
+    Return the parse counts of the session, the same cursor is used for both reads
+    so the statistics query itself is parsed only once
+    '''
+    cur.execute("select n.name, s.value from v$mystat s join v$statname n on n.statistic# = s.statistic# "
+                "where n.name in ('parse count (total)', 'parse count (hard)')")
+    return dict(cur.fetchall())
+
+_ALTER_SESSION = re.compile(r'^\s*alter\s+session\b', re.IGNORECASE)
+
+def _elapsed(start):
+    '''
+    Return time elapsed since start as human and raw value
+    '''
+    elapsed = (time.time() - start)
+    if elapsed < 0.200:
+       elapsed_h = str(round(elapsed * 1000, 1)) + 'ms'
+    else:
+       elapsed_h = str(round(elapsed, 2)) + 's'
+    return {'human': elapsed_h, 'raw': str(round(elapsed, 5))}
+
+_PLSQL_BLOCK = re.compile(r'^\s*(DECLARE|BEGIN|CREATE\s+(OR\s+REPLACE\s+)?((NON)?EDITIONABLE\s+)?'
+                          r'(PROCEDURE|FUNCTION|PACKAGE|TRIGGER|TYPE|LIBRARY))\b', re.IGNORECASE)
+
+def _find_terminator(stmt):
+    '''
+    Return index of the first ";" outside quotes and comments, None if there is none
+    '''
+    quote = False
+    i = 0
+    while i < len(stmt):
+        char = stmt[i]
+        if quote:
+           if char == "'":
+              quote = False
+        elif char == "'":
+           quote = True
+        elif stmt.startswith('--', i):
+           end = stmt.find('\n', i)
+           i = len(stmt) if end == -1 else end
+           continue
+        elif stmt.startswith('/*', i):
+           end = stmt.find('*/', i + 2)
+           i = len(stmt) if end == -1 else end + 2
+           continue
+        elif char == ';':
+           return i
+        i += 1
+    return None
+
+def _split_sql(script):
+    '''
+    Split a SQL script into statements, the way sqlplus does.
+    Statements end with ";", PL/SQL blocks end with a "/" on a line of its own.
+    Comments and terminators inside quoted strings are ignored.
+    '''
+    statements = []
+    buf = []
+    for line in script.splitlines():
+        if line.strip() == '/':
+           stmt = '\n'.join(buf).strip()
+           if stmt:
+              statements.append(stmt.rstrip(';') if not _PLSQL_BLOCK.match(stmt) else stmt)
+           buf = []
+           continue
+        if not buf and (not line.strip() or line.strip().startswith('--')):
+           continue
+        buf.append(line)
+        stmt = '\n'.join(buf)
+        # A line can end several statements
+        while not _PLSQL_BLOCK.match(stmt):
+            cut = _find_terminator(stmt)
+            if cut is None:
+               break
+            if stmt[:cut].strip():
+               statements.append(stmt[:cut].strip())
+            stmt = stmt[cut + 1:].strip()
+            if stmt.startswith('--'):
+               stmt = ''
+        buf = [stmt] if stmt else []
+    stmt = '\n'.join(buf).strip()
+    if stmt:
+       statements.append(stmt if _PLSQL_BLOCK.match(stmt) else stmt.rstrip(';').strip())
+    return statements
+
+def _spool(cur, columns, output, output_format='csv'):
+    '''
+    Write rows of an executed cursor to output file, one arraysize batch at a time.
+    Return the number of bytes written.
+    '''
+    if output_format not in ('csv', 'jsonl'):
+       raise ValueError('Unknown output format {0}, use csv or jsonl'.format(output_format))
+
+    def _value(val):
+        if val is None or isinstance(val, (six.integer_types, float)):
+           return val
+        if isinstance(val, cx_Oracle.LOB):
+           val = val.read()
+        return salt.utils.stringutils.to_unicode(val) if isinstance(val, (six.binary_type, six.text_type)) else six.text_type(val)
+
+    with salt.utils.files.fopen(output, 'w') as ofile:
+        if output_format == 'csv':
+           writer = csv.writer(ofile)
+           writer.writerow([salt.utils.stringutils.to_str(col) for col in columns])
+        while True:
+            rows = cur.fetchmany()
+            if not rows:
+               break
+            for row in rows:
+                if output_format == 'csv':
+                   writer.writerow([salt.utils.stringutils.to_str(val) if isinstance(val, six.text_type) else val
+                                    for val in (_value(val) for val in row)])
+                else:
+                   ofile.write(salt.utils.stringutils.to_str(salt.utils.json.dumps(dict(zip(columns, [_value(val) for val in row]))) + '\n'))
+        return ofile.tell()
+
 @depends('cx_Oracle', fallback_function=_cx_oracle_req)
-def run_query(sid, query, connection_mode=None, **connection_args):
+def run_query(sid, query, connection_mode=None, output=None, output_format='csv', arraysize=None, params=None,
+              parse_stats=False, **connection_args):
 
     '''
     Execute query on the specified database (sid)
@@ -308,8 +514,34 @@ def run_query(sid, query, connection_mode=None, **connection_args):
         The name of the database to execute the query on
     query
         The query to execute
+    output
+        File to spool the rows of a select query into, as they are fetched.
+        Only summary (rows returned, bytes, query time) is returned then.
+        OR None: rows are returned in result (default)
+    output_format
+        csv (default, with a header line) or jsonl (one json object per row)
+    arraysize
+        Number of rows fetched per round trip (default oracle.arraysize or 500)
+    params
+        Bind values of the query, dict for named (:name) or list for positional (:1) binds.
+        Binding keeps one shared cursor on the server and lets the session statement
+        cache reuse the parsed statement.
+    parse_stats
+        If True, return the 'parse count (total)' and 'parse count (hard)' of the session
+        spent on the query, read from v$mystat before and after it (needs select on v$mystat
+        and v$statname). A statement found in the statement cache is not parsed again.
     **connection_args
         Oracle Connection arguments
+
+    Sessions are pooled (see oracle.pool), an ALTER SESSION query does not outlive
+    the call: its session is closed instead of returned to the pool.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' devops_oracle.run_query ORCL "select * from dba_objects" output=/tmp/objects.jsonl output_format=jsonl
+        salt '*' devops_oracle.run_query ORCL "select status from v$instance where instance_name = :name" params='{name: ORCL}'
     '''
 
     ret = {}
@@ -325,55 +557,230 @@ def run_query(sid, query, connection_mode=None, **connection_args):
     if conn is None:
        return ret
 
-    start = time.time()
-    log.debug('Using db: %s to run query %s', sid, query)
+    try:
+        start = time.time()
+        log.debug('Using db: %s to run query %s', sid, query)
+
+        cur = conn.cursor()
+        cur.arraysize = int(arraysize or _config('arraysize', 500))
+        try:
+            if parse_stats:
+               stats_cur = conn.cursor()
+               before = _parse_counts(stats_cur)
+            exec_start = time.time()
+            if params:
+               cur.execute(query, params)
+            else:
+               cur.execute(query)
+            ret['execute time'] = _elapsed(exec_start)
+            if parse_stats:
+               after = _parse_counts(stats_cur)
+               for name in after:
+                   ret[name] = after[name] - before.get(name, 0)
+            affected = cur.rowcount
+            log.debug(query)
+        except cx_Oracle.DatabaseError as err:
+            query_error= '{}: {}'.format(query, err)
+            __context__['devops_oracle.error'] = query_error
+            log.error(err)
+            return ret
+
+        select_keywords = ["SELECT", "SHOW", "DESC"]
+        select_query = False
+        for keyword in select_keywords:
+            if query.upper().strip().startswith(keyword):
+               select_query = True
+               break
+        '''
+        alter_keywords = ["ALTER"]
+        alter_query = False
+        for keyword in alter_keywords:
+            if query.upper().strip().startswith(keyword):
+               alter_query = True
+               break
+        '''
+
+        if select_query:
+           columns = ()
+           for column in cur.description:
+               columns += (column[0],)
+           ret['columns'] = columns
+           if output is not None:
+              try:
+                  ret['bytes'] = _spool(cur, columns, output, output_format)
+              except (IOError, OSError, ValueError) as err:
+                  __context__['devops_oracle.error'] = 'Cannot write {0}: {1}'.format(output, err)
+                  log.error(err)
+                  return {}
+              ret['output'] = output
+           else:
+              ret['result'] = cur.fetchall()
+           ret['query time'] = _elapsed(start)
+           ret['rows returned'] = cur.rowcount
+           return ret
+        else:
+           ret['rows affected'] = affected
+           #ret["result"] = True
+           return ret
+    finally:
+        _disconnect(conn, drop=bool(_ALTER_SESSION.match(query)))
+
+@depends('cx_Oracle', fallback_function=_cx_oracle_req)
+def run_queries(sid, queries, transaction=False, stop_on_error=True, connection_mode=None, **connection_args):
+
+    '''
+    Execute a list of queries in order on the specified database (sid) over a single session
+    sid
+        The name of the database to execute the queries on
+    queries
+        List of queries. Each item is a query string or a dict
+        {'query': 'insert into t values (:1, :2)', 'params': [[1, 'a'], [2, 'b']]}
+        params is a dict/list of bind values, or a list of them to run the DML with executemany
+    transaction
+        If True run all queries in one transaction, committed at the end and rolled back
+        on first error. If False every query is committed as it runs
+    stop_on_error
+        Stop at first failing query (always True when transaction is True)
+    **connection_args
+        Oracle Connection arguments
 
-    cur = conn.cursor()
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' devops_oracle.run_queries ORCL '["grant select on t to u", "alter user u quota unlimited on users"]'
+    '''
+
+    ret = {'result': False, 'statements': []}
+    global authorization_modes
+    if connection_mode is not None:
+       mode = authorization_modes[connection_mode]
+    else:
+       mode = None
+    connection_args.update({'connection_sid': sid, 'connection_mode': mode})
+    conn = _connect(**connection_args)
+
+    if conn is None:
+       return ret
+
+    start = time.time()
+    failed = False
     try:
-        cur.execute(query)
-        affected = cur.rowcount
-        log.debug(query)
+        conn.autocommit = not transaction
+        cur = conn.cursor()
+        for item in queries:
+            if isinstance(item, dict):
+               query = item['query']
+               params = item.get('params')
+            else:
+               query = item
+               params = None
+
+            stmt = {'query': query}
+            stmt_start = time.time()
+            log.debug('Using db: %s to run query %s', sid, query)
+            try:
+                if params and isinstance(params, list) and isinstance(params[0], (list, tuple, dict)):
+                   cur.executemany(query, params)
+                elif params:
+                   cur.execute(query, params)
+                else:
+                   cur.execute(query)
+                if cur.description:
+                   stmt['columns'] = tuple(column[0] for column in cur.description)
+                   stmt['result'] = cur.fetchall()
+                   stmt['rows returned'] = cur.rowcount
+                else:
+                   stmt['rows affected'] = cur.rowcount
+            except cx_Oracle.DatabaseError as err:
+                stmt['error'] = str(err)
+                log.error('%s: %s', query, err)
+                failed = True
+            stmt['query time'] = _elapsed(stmt_start)
+            ret['statements'].append(stmt)
+            if failed and (transaction or stop_on_error):
+               break
+
+        if transaction:
+           if failed:
+              conn.rollback()
+              ret['comment'] = 'Transaction rolled back'
+           else:
+              conn.commit()
+              ret['comment'] = 'Transaction committed'
     except cx_Oracle.DatabaseError as err:
-        query_error= '{}: {}'.format(query, err)
-        __context__['devops_oracle.error'] = query_error
+        __context__['devops_oracle.error'] = 'Oracle Error {0}'.format(err)
         log.error(err)
-        return ret
+        failed = True
+    finally:
+        try:
+            conn.autocommit = False
+        except cx_Oracle.DatabaseError:
+            pass
+        _disconnect(conn, drop=any(_ALTER_SESSION.match(stmt['query']) for stmt in ret['statements']))
+
+    if failed:
+       errors = [stmt for stmt in ret['statements'] if 'error' in stmt]
+       if errors:
+          __context__['devops_oracle.error'] = '{0}: {1}'.format(errors[0]['query'], errors[0]['error'])
+    ret['result'] = not failed
+    ret['query time'] = _elapsed(start)
+    return ret
 
-    select_keywords = ["SELECT", "SHOW", "DESC"]
-    select_query = False
-    for keyword in select_keywords:
-        if query.upper().strip().startswith(keyword):
-           select_query = True
-           break
-    '''
-    alter_keywords = ["ALTER"]
-    alter_query = False
-    for keyword in alter_keywords:
-        if query.upper().strip().startswith(keyword):
-           alter_query = True
-           break
-    '''
-
-    if select_query:
-       results = cur.fetchall()
-       elapsed = (time.time() - start)
-       if elapsed < 0.200:
-          elapsed_h = str(round(elapsed * 1000, 1)) + 'ms'
-       else:
-          elapsed_h = str(round(elapsed, 2)) + 's'
-       ret['query time'] = {'human': elapsed_h, 'raw': str(round(elapsed, 5))}
-       ret['rows returned'] = affected
-       columns = ()
-       for column in cur.description:
-           columns += (column[0],)
-       ret['columns'] = columns
-       ret['result'] = results
+@depends('cx_Oracle', fallback_function=_cx_oracle_req)
+def run_script(sid, script=None, source=None, transaction=False, stop_on_error=True, connection_mode=None, **connection_args):
+
+    '''
+    Execute a SQL script on the specified database (sid) over a single session
+    Statements end with ";", PL/SQL blocks end with "/" on a line of its own
+    sid
+        The name of the database to execute the script on
+    script
+        SQL script text
+    source
+        SQL script file, local path or salt://, http://, https:// etc.
+    transaction
+        If True run the script in one transaction, see run_queries
+    stop_on_error
+        Stop at first failing statement
+    **connection_args
+        Oracle Connection arguments
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' devops_oracle.run_script ORCL source=salt://oracle/files/bootstrap.sql transaction=True
+    '''
+
+    ret = {'result': False, 'statements': []}
+
+    if script is not None and source is not None:
+       ret['comment'] = "You can't provide both script and source, pass script or source"
        return ret
-    else:
-       ret['rows affected'] = affected
-       #ret["result"] = True
+
+    if source is not None:
+       if any(source.startswith(proto) for proto in ('salt://', 'http://', 'https://', 'swift://', 's3://')):
+          source = __salt__['cp.cache_file'](source)
+
+       if not source or not os.path.exists(source):
+          log.error('File "%s" does not exist', source)
+          ret['comment'] = 'File {} does not exist'.format(source)
+          return ret
+       with salt.utils.files.fopen(source, 'r') as ifile:
+            script = salt.utils.stringutils.to_unicode(ifile.read())
+    elif script is None:
+       ret['comment'] = 'please provide value for script or source'
        return ret
-    return ret
+
+    queries = _split_sql(script)
+    if not queries:
+       ret['result'] = True
+       ret['comment'] = 'No statement found'
+       return ret
+
+    return run_queries(sid, queries, transaction=transaction, stop_on_error=stop_on_error,
+                       connection_mode=connection_mode, **connection_args)
 
 @depends('cx_Oracle', fallback_function=_cx_oracle_req)
 def get_temporary_tablespace_nonasm(sid, **connection_args):
@@ -456,6 +863,117 @@ def get_instnace_mode(sid, **connection_args):
        return response['result']
     return False
 
+def _instance_status(sid, timeout, conn_args, pool, stmtcachesize):
+    '''
+    Return v$instance status columns of one database, run in a pool thread.
+    Connection arguments and session pool are resolved by the caller: the pool
+    threads do not see __salt__ and __context__ on Salt 3003+.
+    '''
+    ret = {}
+    start = time.time()
+    try:
+        if pool is not None:
+           conn = _acquire(pool, stmtcachesize)
+        else:
+           conn = cx_Oracle.connect(conn_args['user'], conn_args['pass'], conn_args['dsn'])
+    except cx_Oracle.DatabaseError as err:
+        log.error('%s: %s', sid, err)
+        return {'error': 'Oracle Error {0}'.format(err)}
+
+    try:
+        if timeout:
+           try:
+               conn.callTimeout = int(timeout * 1000)
+           except AttributeError:
+               pass
+        cur = conn.cursor()
+        cur.execute('select STATUS, DATABASE_STATUS, VERSION, LOGINS from v$instance')
+        row = cur.fetchone()
+        for idx, column in enumerate(cur.description):
+            ret[column[0].lower()] = row[idx]
+    except cx_Oracle.DatabaseError as err:
+        log.error('%s: %s', sid, err)
+        ret['error'] = str(err)
+    finally:
+        try:
+            conn.callTimeout = 0
+        except (AttributeError, cx_Oracle.DatabaseError):
+            pass
+        try:
+            if pool is not None:
+               pool.release(conn)
+            else:
+               conn.close()
+        except cx_Oracle.DatabaseError:
+            pass
+    ret['query time'] = _elapsed(start)
+    return ret
+
+@depends('cx_Oracle', fallback_function=_cx_oracle_req)
+def status_many(sids, timeout=10, concurrency=None, **connection_args):
+
+    '''
+    Return instance status, database status, version and logins mode of several
+    databases, queried concurrently on a thread pool
+    sids
+        List of database names
+    timeout
+        Seconds allowed per database, a database not answering in time is
+        reported with an error
+    concurrency
+        Number of databases queried at the same time
+        (default oracle.status_concurrency or 16)
+    **connection_args
+        Oracle Connection arguments
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' devops_oracle.status_many '[ORCL1, ORCL2, ORCL3]' timeout=5
+    '''
+
+    ret = {}
+    if isinstance(sids, six.string_types):
+       sids = [sid.strip() for sid in sids.split(',') if sid.strip()]
+    if not sids:
+       return ret
+
+    concurrency = max(1, min(len(sids), int(concurrency or _config('status_concurrency', 16))))
+    use_pool = _config('pool', True)
+    stmtcachesize = int(_config('stmtcachesize', 50))
+    targets = []
+    for sid in sids:
+        args = dict(connection_args)
+        args.update({'connection_sid': sid, 'connection_mode': None})
+        conn_args = _connection_args(**args)
+        try:
+            session_pool = _get_pool(conn_args) if use_pool else None
+        except cx_Oracle.DatabaseError as err:
+            log.error('%s: %s', sid, err)
+            ret[sid] = {'error': 'Oracle Error {0}'.format(err)}
+            continue
+        targets.append((sid, conn_args, session_pool))
+    if not targets:
+       return ret
+
+    pool = ThreadPool(concurrency)
+    try:
+        jobs = [(sid, pool.spawn(_instance_status, sid, timeout, conn_args, session_pool, stmtcachesize))
+                for sid, conn_args, session_pool in targets]
+        # Queued databases start when a previous one is done, allow one timeout per round
+        deadline = time.time() + (timeout or 0) * ((len(sids) + concurrency - 1) // concurrency)
+        for sid, job in jobs:
+            wait = max(deadline - time.time(), 0.001) if timeout else None
+            try:
+                ret[sid] = job.get(timeout=wait)
+            except gevent.Timeout:
+                log.error('%s: no answer in %s seconds', sid, timeout)
+                ret[sid] = {'error': 'No answer in {0} seconds'.format(timeout)}
+    finally:
+        pool.kill()
+    return ret
+
 @depends('cx_Oracle', fallback_function=_cx_oracle_req)
 def get_oradata(sid, asm=False, **connection_args):
 
@@ -537,7 +1055,24 @@ def _disable_block_change_tracking(sid, **connection_args):
 
     log.info('Block change tracking sucessfully disabled!')
 
-def restoredb_from_backup_location(sid, backup_dir, oradata, newname='default', **connection_args):
+def _rman_connection_args(sid, connection_args):
+    '''
+    Return connection_args for execute_script, completed with the arguments
+    of the minion config or pillar
+    '''
+    args = dict(connection_args)
+    args['connection_sid'] = sid
+    try:
+        conn_args = _connection_args(**args)
+    except KeyError:
+        # execute_script reports the missing arguments
+        return dict(connection_args)
+    rman_args = dict(('connection_{0}'.format(key), conn_args[key]) for key in ('host', 'port', 'user', 'pass') if key in conn_args)
+    rman_args.update(connection_args)
+    return rman_args
+
+def restoredb_from_backup_location(sid, backup_dir, oradata, newname='default', channels=1, redo_groups=2,
+                                   redo_size='4M', skip_tablespaces=None, open_database=False, **connection_args):
 
     '''
     Restore a DB from RMAN backup location
@@ -549,6 +1084,17 @@ def restoredb_from_backup_location(sid, backup_dir, oradata, newname='default',
         Directory location of oracle database files
     newname
         set newname for database datafiles and tempfiles
+    channels
+        Number of auxiliary disk channels, datafiles are restored in parallel (default 1)
+    redo_groups
+        Number of redo log groups of the new database, two members each (default 2)
+    redo_size
+        Size of each redo log member (default 4M)
+    skip_tablespaces
+        List of tablespaces which are not restored
+    open_database
+        If True open the database with resetlogs after the duplicate
+        OR False: database is left mounted (default)
     **connection_args
         Oracle Connection arguments
 
@@ -558,6 +1104,14 @@ def restoredb_from_backup_location(sid, backup_dir, oradata, newname='default',
     %f is the absolute datafile number
 
     set newname for block change tracking file doesn't work unfortunately.
+
+    Return execute_script result with timing of each phase (restore, recover, open)
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' devops_oracle.restoredb_from_backup_location TESTDB /backup/ORCL /oradata/TESTDB channels=4 redo_groups=3 redo_size=512M skip_tablespaces='[USERS_ARCHIVE]' open_database=True
     '''
 
     '''
@@ -566,67 +1120,146 @@ def restoredb_from_backup_location(sid, backup_dir, oradata, newname='default',
        return False
     '''
 
+    ret = {'result': False}
+
     if not _is_oracle_home_set():
-       return False
+       ret['comment'] = 'Oracle home is not set'
+       return ret
 
     query = 'select instance_name from v$instance'
     response = run_query(sid, query, **connection_args)
 
     if not response.get('result'):
        log.error('Can not query instance_name: {}'.format(query))
-       return False
+       ret['comment'] = __context__.pop('devops_oracle.error', 'Can not query instance_name')
+       return ret
 
     non_asm = get_temporary_tablespace_nonasm(sid, **connection_args)
 
+    channels = max(1, int(channels))
+    allocate = ''
+    for channel in range(1, channels + 1):
+        allocate += 'allocate auxiliary channel aux{0} device type disk;\n           '.format(channel)
+
+    logfiles = []
+    for group in range(1, int(redo_groups) + 1):
+        logfiles.append("group {0} ('{1}', '{2}') size {3} reuse".format(
+            group,
+            os.path.join(oradata, 'redo{0:02d}a.log'.format(group)),
+            os.path.join(oradata, 'redo{0:02d}b.log'.format(group)),
+            redo_size))
+
+    if isinstance(skip_tablespaces, six.string_types):
+       skip_tablespaces = [skip_tablespaces]
+    skip = ''
+    if skip_tablespaces:
+       skip = '\n           skip tablespace {0}'.format(', '.join(skip_tablespaces))
+
     if non_asm:
-       script = '''
-       connect auxiliary {user}/{password}@{auxiliary_dsn}
-       run {{
-           set newname for database to '{newname}';
-           duplicate database to {auxiliary_sid} noopen nofilenamecheck
-           undo tablespace UNDOTBS1
-           logfile group 1 ('{redo01a}', '{redo01b}') size 4M reuse,
-           group 2 ('{redo02a}', '{redo02b}') size 4M reuse
-           backup location '{backupset_dir}';
-       }}
-       '''
+       set_newname = "set newname for database to '{0}';\n           ".format(
+           os.path.join(oradata, '{}_D-%d_TS-%N_FNO-%f'.format(newname)))
     else:
-       script = '''
-       connect auxiliary {user}/{password}@{auxiliary_dsn}
+       set_newname = ''
+
+    script = '''
        run {{
-           duplicate database to {auxiliary_sid} noopen nofilenamecheck
-           undo tablespace UNDOTBS1
-           logfile group 1 ('{redo01a}', '{redo01b}') size 4M reuse,
-           group 2 ('{redo02a}', '{redo02b}') size 4M reuse
+           {allocate}{set_newname}duplicate database to {auxiliary_sid} noopen nofilenamecheck
+           undo tablespace UNDOTBS1{skip}
+           logfile {logfiles}
            backup location '{backupset_dir}';
        }}
        '''
     script = script.format(
-        user=connargs['user'],
-        password=connargs['pass'],
-        auxiliary_dsn=connargs['dsn'],
-        newname=os.path.join(oradata, '{}_D-%d_TS-%N_FNO-%f'.format(newname)),
+        allocate=allocate,
+        set_newname=set_newname,
         auxiliary_sid=sid,
-        redo01a=os.path.join(oradata, 'redo01a.log'),
-        redo01b=os.path.join(oradata, 'redo01b.log'),
-        redo02a=os.path.join(oradata, 'redo02a.log'),
-        redo02b=os.path.join(oradata, 'redo02b.log'),
+        skip=skip,
+        logfiles=',\n           '.join(logfiles),
         backupset_dir=backup_dir,
     )
+    log.debug(script)
 
     # avoid ORA-19755 bug
     if non_asm:
        bct_let = Greenlet.spawn(_disable_block_change_tracking, sid, **connection_args)
 
     # Run RMAN Script
-    rman_let = Greenlet.spawn(execute_script, script)
+    rman_let = Greenlet.spawn(execute_script, sid, script, 'restore', 'SYSDBA', **_rman_connection_args(sid, connection_args))
     rman_let.join()
 
     if non_asm:
        bct_let.join(timeout=5)
-    return rman_let.value
 
-def backup(sid, backup_dir, full_backup=False, **connection_args):
+    ret = rman_let.value or {'result': False, 'comment': str(rman_let.exception)}
+    ret.setdefault('phases', {})
+    if ret['result'] and open_database:
+       start = time.time()
+       run_query(sid, 'alter database open resetlogs', 'SYSDBA', **connection_args)
+       err = __context__.pop('devops_oracle.error', None)
+       ret['phases']['open'] = {'elapsed': _elapsed(start)}
+       if err is not None:
+          ret['result'] = False
+          ret['errors'].append(err)
+    return ret
+
+def _enable_block_change_tracking(sid, bct_file=None, connection_mode='SYSDBA', **connection_args):
+    '''
+    Enable block change tracking if it is not, and check it is ENABLED in V$BLOCK_CHANGE_TRACKING
+    '''
+    ret = {'result': False}
+    query = 'select status, filename from v$block_change_tracking'
+    response = run_query(sid, query, connection_mode, **connection_args)
+    if not response.get('result'):
+       ret['comment'] = __context__.pop('devops_oracle.error', 'Can not run query {}'.format(query))
+       return ret
+
+    status, filename = response['result'][0]
+    if status != 'ENABLED':
+       alter = 'alter database enable block change tracking'
+       if bct_file:
+          alter += " using file '{0}' reuse".format(bct_file)
+       run_query(sid, alter, connection_mode, **connection_args)
+       err = __context__.pop('devops_oracle.error', None)
+       if err is not None:
+          ret['comment'] = err
+          return ret
+       log.info('Block change tracking enabled on %s', sid)
+       ret['changes'] = 'Block change tracking enabled'
+
+       response = run_query(sid, query, connection_mode, **connection_args)
+       if not response.get('result'):
+          ret['comment'] = __context__.pop('devops_oracle.error', 'Can not run query {}'.format(query))
+          return ret
+       status, filename = response['result'][0]
+
+    ret['status'] = status
+    ret['file'] = filename
+    ret['result'] = status == 'ENABLED'
+    if not ret['result']:
+       ret['comment'] = 'Block change tracking is {0}'.format(status)
+    return ret
+
+def _rman_job_details(sid, **connection_args):
+    '''
+    Return size and throughput of the last RMAN job from V$RMAN_BACKUP_JOB_DETAILS
+    '''
+    query = ('select status, input_bytes, output_bytes, elapsed_seconds, input_bytes_per_sec, '
+             'output_bytes_per_sec, compression_ratio from v$rman_backup_job_details '
+             'where session_key = (select max(session_key) from v$rman_backup_job_details)')
+    response = run_query(sid, query, **connection_args)
+    __context__.pop('devops_oracle.error', None)
+    if not response.get('result'):
+       return {}
+
+    details = dict(zip([column.lower() for column in response['columns']], response['result'][0]))
+    for key in ('input_bytes_per_sec', 'output_bytes_per_sec'):
+        if details.get(key) is not None:
+           details[key.replace('bytes_per_sec', 'MB/s')] = round(float(details[key]) / 1024 / 1024, 2)
+    return details
+
+def backup(sid, backup_dir, full_backup=False, channels=1, section_size=None, filesperset=None,
+           maxpiecesize=None, compression='BASIC', strategy='backupset', tag='SALT_INCR_MERGE',
+           bct_file=None, connection_mode='SYSDBA', **connection_args):
 
     '''
     Backup a DB to RMAN backup location
@@ -636,43 +1269,135 @@ def backup(sid, backup_dir, full_backup=False, **connection_args):
         RMAN backup directory location to backup a database
     full_backup
         Default is False. If True then full backup is taken at backup location
+    channels
+        Number of disk channels allocated, datafiles are backed up in parallel (default 1)
+    section_size
+        Multisection backup, big datafiles are split in sections of this size
+        across channels, e.g. 32G. Can not be used with maxpiecesize
+    filesperset
+        Maximum number of datafiles in one backupset
+    maxpiecesize
+        Maximum size of a backup piece, e.g. 16G
+    compression
+        BASIC (default), LOW, MEDIUM or HIGH (LOW, MEDIUM and HIGH need Advanced Compression)
+        OR True: BASIC, False: backupset is not compressed
+        The algorithm is SET in the run block, it applies to this backup only
+    strategy
+        backupset (default): level 0 backupset, then level 1 backupsets
+        incremental_merge: incrementally updated image copies. First run creates
+        image copies of datafiles in backup_dir, each next run takes a level 1
+        backup and merges it into the copies, so a restore is a switch to copy.
+        Block change tracking is enabled and checked in V$BLOCK_CHANGE_TRACKING,
+        so level 1 backups read only changed blocks
+    tag
+        Tag of the image copies, used with incremental_merge
+    bct_file
+        Block change tracking file, used when block change tracking has to be enabled.
+        Default is a file in DB_CREATE_FILE_DEST
     **connection_args
         Oracle Connection arguments
+
+    Return execute_script result with level, channels, and input/output bytes,
+    MB/s and compression ratio of the run from V$RMAN_BACKUP_JOB_DETAILS
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt '*' devops_oracle.backup ORCL /backup/ORCL channels=8 section_size=32G compression=MEDIUM
+        salt '*' devops_oracle.backup ORCL /backup/ORCL strategy=incremental_merge channels=4
     '''
 
+    ret = {'result': False}
+
+    if strategy not in ('backupset', 'incremental_merge'):
+       ret['comment'] = 'Unknown strategy {0}, use backupset or incremental_merge'.format(strategy)
+       return ret
+
     if not _is_oracle_home_set():
-       return False
+       ret['comment'] = 'Oracle home is not set'
+       return ret
 
-    query = 'select recid from v$backup_datafile where incremental_level = 0'
-    response = run_query(sid, query, **connection_args)
+    if section_size and maxpiecesize:
+       ret['comment'] = 'section_size and maxpiecesize can not be used together'
+       return ret
+
+    if compression is True:
+       compression = 'BASIC'
+    elif compression:
+       compression = six.text_type(compression).upper()
+    if compression and compression not in ('BASIC', 'LOW', 'MEDIUM', 'HIGH'):
+       ret['comment'] = 'Unknown compression {0}, use BASIC, LOW, MEDIUM or HIGH'.format(compression)
+       return ret
+
+    if strategy == 'incremental_merge':
+       bct = _enable_block_change_tracking(sid, bct_file, connection_mode, **connection_args)
+       if not bct.get('result'):
+          return bct
+       # Level 0 image copies are made when no copy with this tag exists
+       query = "select file# from v$datafile_copy where tag = :tag and status = 'A'"
+       response = run_query(sid, query, params={'tag': tag.upper()}, **connection_args)
+    else:
+       query = 'select recid from v$backup_datafile where incremental_level = 0'
+       response = run_query(sid, query, **connection_args)
 
-    if not response.has_key("result"):
+    if 'result' not in response:
        log.error('Can not run query {}'.format(query))
-       return False
+       ret['comment'] = __context__.pop('devops_oracle.error', 'Can not run query {}'.format(query))
+       return ret
 
     if full_backup:
        level = 0
     else:
        level = 0 if not response['result'] else 1
 
+    channels = max(1, int(channels))
+    backupset_dir = os.path.join(backup_dir, '%U')
+    allocate = ''
+    release = ''
+    for channel in range(1, channels + 1):
+        allocate += "allocate channel ch{0} device type disk format '{1}'{2};\n        ".format(
+            channel, backupset_dir, ' maxpiecesize {0}'.format(maxpiecesize) if maxpiecesize else '')
+        release += 'release channel ch{0};\n        '.format(channel)
+
+    options = ''
+    if section_size:
+       options += '\n            section size {0}'.format(section_size)
+    if filesperset:
+       options += '\n            filesperset {0}'.format(int(filesperset))
+
+    backupset_type = 'compressed backupset' if compression else 'backupset'
+    recover = ''
+    if strategy == 'incremental_merge':
+       recover = "recover copy of database with tag '{0}';\n        ".format(tag.upper())
+       if level == 0 and response['result']:
+          # full_backup: new level 0 image copies, next runs merge into them
+          backup_type = "as copy incremental level 0 tag '{0}'".format(tag.upper())
+       else:
+          # RMAN makes the level 0 image copies itself when none exists
+          backup_type = "as {0} incremental level 1 for recover of copy with tag '{1}'".format(backupset_type, tag.upper())
+    else:
+       backup_type = 'as {0} incremental level {1}'.format(backupset_type, level)
+
     script = '''
-    connect target {user}/{password}@{target_dsn}
     CONFIGURE CONTROLFILE AUTOBACKUP FORMAT FOR DEVICE TYPE DISK TO '{autobackup_format}';
     run {{
-        backup as compressed backupset
-            incremental level {level}
+        {set_compression}{allocate}{recover}backup {backup_type}{options}
             database
             include current controlfile
             format '{backupset_dir}';
+        {release}
     }}
     '''
     script = script.format(
-        user=connargs['user'],
-        password=connargs['pass'],
-        target_dsn=connargs['dsn'],
         autobackup_format=os.path.join(backup_dir, '%F'),
-        level=level,
-        backupset_dir=os.path.join(backup_dir, '%U'),
+        set_compression="SET COMPRESSION ALGORITHM '{0}';\n        ".format(compression) if compression else '',
+        allocate=allocate,
+        recover=recover,
+        backup_type=backup_type,
+        release=release.rstrip(),
+        options=options,
+        backupset_dir=backupset_dir,
     )
 
     log.debug(script)
@@ -681,13 +1406,74 @@ def backup(sid, backup_dir, full_backup=False, **connection_args):
     #bct_let = Greenlet.spawn(_disable_block_change_tracking, **connection_args)
 
     # Run RMAN script
-    rman_let = Greenlet.spawn(execute_script, script)
+    rman_let = Greenlet.spawn(execute_script, sid, script, 'backup', connection_mode, **_rman_connection_args(sid, connection_args))
 
     rman_let.join()
     # bct_let.join(timeout=5)
 
-    return rman_let.value
+    ret = rman_let.value or {'result': False, 'comment': str(rman_let.exception)}
+    ret['level'] = level
+    ret['channels'] = channels
+    ret['strategy'] = strategy
+    if strategy == 'incremental_merge':
+       ret['block change tracking'] = bct
+    if ret.get('returncode') is not None:
+       ret.update(_rman_job_details(sid, **connection_args))
+
+    return ret
+
 
+_RMAN_ERROR = re.compile(r'\b(RMAN|ORA)-\d{5}\b')
+# Lines of an error stack, RMAN-00569 is its "ERROR MESSAGE STACK FOLLOWS" banner
+_RMAN_FAILURE = re.compile(r'\bRMAN-(00569|03002|03009)\b')
+_RMAN_PROGRESS = re.compile(r'^\s*channel (\S+): (.*)$')
+_RMAN_PHASE = re.compile(r'^\s*(Starting|Finished) (\w+) at ')
+_RMAN_OUTPUT_TAIL = 50
+
+def _rman_log_file(sid):
+    '''
+    Return the RMAN log file of database sid under the minion cachedir
+    '''
+    return os.path.join(__opts__['cachedir'], 'devops_oracle', 'rman', '{0}.log'.format(sid))
+
+def _rman_logger(sid, path):
+    '''
+    Return a logger writing RMAN output of database sid into a rotating log file
+    '''
+    if not os.path.isdir(os.path.dirname(path)):
+       os.makedirs(os.path.dirname(path))
+    handler = logging.handlers.RotatingFileHandler(path,
+                                                   maxBytes=int(_config('rman_log_max_bytes', 10 * 1024 * 1024)),
+                                                   backupCount=int(_config('rman_log_backups', 5)))
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    rman_log = logging.getLogger('{0}.rman.{1}'.format(__name__, sid))
+    rman_log.propagate = False
+    rman_log.setLevel(logging.INFO)
+    rman_log.addHandler(handler)
+    return rman_log
+
+def _rman_event(sid, stage, data):
+    '''
+    Fire devops_oracle/rman/<sid>/<stage> event
+    '''
+    try:
+        __salt__['event.send']('devops_oracle/rman/{0}/{1}'.format(sid, stage), data)
+    except Exception as exc:
+        log.debug('Cannot send RMAN event: %s', exc)
+
+def _rman_progress(sid, interval, connection_mode, connection_args):
+    '''
+    Fire the percent done of running RMAN jobs every interval seconds
+    '''
+    query = ('select sum(sofar), sum(totalwork) from v$session_longops '
+             "where opname like 'RMAN%aggregate%' and totalwork > 0 and sofar <> totalwork")
+    while True:
+        gevent.sleep(interval)
+        response = run_query(sid, query, connection_mode, **dict(connection_args))
+        __context__.pop('devops_oracle.error', None)
+        for sofar, totalwork in response.get('result') or []:
+            if totalwork:
+               _rman_event(sid, 'progress', {'percent': round(float(sofar) * 100 / float(totalwork), 2)})
 
 def execute_script(sid, script, action, connection_mode='SYSDBA', **connection_args):
 
@@ -699,6 +1485,25 @@ def execute_script(sid, script, action, connection_mode='SYSDBA', **connection_a
         if True then remote connection string will be appended to script
     **connection_args
         if remote_target is True then oracle connection_args will be considered
+
+    RMAN output is read line by line while it runs and written to
+    <cachedir>/devops_oracle/rman/<sid>.log, rotated at oracle.rman_log_max_bytes
+    (default 10MB) keeping oracle.rman_log_backups (default 5) files.
+
+    Events are fired on the minion event bus, so long backups can be followed:
+        devops_oracle/rman/<sid>/start
+        devops_oracle/rman/<sid>/progress  channel messages, and percent done from
+                                           v$session_longops every oracle.rman_progress_interval
+                                           seconds (default 60, 0 disables)
+        devops_oracle/rman/<sid>/error     RMAN- and ORA- lines
+        devops_oracle/rman/<sid>/warning   RMAN- lines flagged WARNING, they do not fail the run
+        devops_oracle/rman/<sid>/finish
+
+    result is False when RMAN exits non zero or prints an error stack (RMAN-00569,
+    RMAN-03002, RMAN-03009)
+
+    Return a dict with result, returncode, errors, warnings, elapsed, log, the last lines of output
+    and phases: elapsed time of each "Starting <phase> at"/"Finished <phase> at" RMAN step
     '''
 
     # sys passsowrd in Salt logs
@@ -715,10 +1520,10 @@ def execute_script(sid, script, action, connection_mode='SYSDBA', **connection_a
        database_type = rman_action[action]
     except KeyError:
        log.error('restore and backup action supported only')
-       return False
+       return {'result': False, 'errors': ['restore and backup action supported only']}
 
     if not _is_oracle_home_set():
-       return False
+       return {'result': False, 'errors': ['Oracle home is not set']}
 
     try:
        dsn      = '{0}:{1}/{2}'.format(connection_args['connection_host'], connection_args['connection_port'], sid)
@@ -726,7 +1531,7 @@ def execute_script(sid, script, action, connection_mode='SYSDBA', **connection_a
        password = connection_args['connection_pass']
     except KeyError:
        log.error('Some database connections arguments are missing')
-       return False
+       return {'result': False, 'errors': ['Some database connections arguments are missing']}
 
     remote_conn = 'connect {database_type} "{user}/{password}@{target_dsn} as {connect_mode}"\n'
     remote_conn = remote_conn.format(database_type=database_type, user=user, password=password, target_dsn=dsn, connect_mode=mode)
@@ -736,25 +1541,81 @@ def execute_script(sid, script, action, connection_mode='SYSDBA', **connection_a
     oracle_home = os.environ.get('ORACLE_HOME')
     env={'ORACLE_HOME': oracle_home, 'PATH': os.path.join(oracle_home, 'bin')}
 
-    log.debug(script)
-    log.debug(remote_conn)
+    ret = {'result': False, 'errors': [], 'warnings': [], 'log': _rman_log_file(sid)}
+    failed = False
+    start = time.time()
+    secret = password or None
     try:
-        proc = gevent.subprocess.Popen(args=['rman'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+        proc = gevent.subprocess.Popen(args=['rman'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT, env=env, universal_newlines=True)
     except OSError as err:
         log.debug('cannot start RMAN: {}'.format(err))
-        return False
-
-    proc.stdin.write(script)
-    proc.stdin.close()
+        ret['errors'].append(str(err))
+        return ret
 
-    proc.stdout.close()
-    proc.wait()
+    output = collections.deque(maxlen=_RMAN_OUTPUT_TAIL)
+    phases = {}
+    rman_log = _rman_logger(sid, ret['log'])
+    _rman_event(sid, 'start', {'action': action, 'log': ret['log']})
+    poller = None
+    interval = int(_config('rman_progress_interval', 60))
+    if interval > 0:
+       poller = Greenlet.spawn(_rman_progress, sid, interval, connection_mode, connection_args)
 
+    try:
+        try:
+            proc.stdin.write(script)
+            proc.stdin.close()
+        except (IOError, OSError) as err:
+            # RMAN exited early, its output tells why
+            log.debug('cannot write RMAN script: {}'.format(err))
+
+        # Read while RMAN runs, so a full pipe never stalls it
+        for line in iter(proc.stdout.readline, ''):
+            line = line.rstrip('\n')
+            if secret:
+               line = line.replace(secret, '****')
+            rman_log.info(line)
+            output.append(line)
+            phase = _RMAN_PHASE.match(line)
+            if phase:
+               step = phases.setdefault(phase.group(2).lower(), {})
+               if phase.group(1) == 'Starting':
+                  step.setdefault('start', time.time())
+               else:
+                  # A phase can run several times (control file, then datafiles), time first start to last finish
+                  step['elapsed'] = _elapsed(step.get('start', start))
+            if _RMAN_ERROR.search(line) and 'WARNING' in line.upper():
+               # e.g. RMAN-05538: WARNING: implicitly using DB_FILE_NAME_CONVERT
+               ret['warnings'].append(line.strip())
+               _rman_event(sid, 'warning', {'line': line.strip()})
+            elif _RMAN_ERROR.search(line):
+               failed = failed or bool(_RMAN_FAILURE.search(line))
+               ret['errors'].append(line.strip())
+               _rman_event(sid, 'error', {'line': line.strip()})
+            else:
+               match = _RMAN_PROGRESS.match(line)
+               if match:
+                  _rman_event(sid, 'progress', {'channel': match.group(1), 'message': match.group(2)})
+        proc.stdout.close()
+        proc.wait()
+    finally:
+        if poller is not None:
+           poller.kill()
+        for handler in list(rman_log.handlers):
+            handler.close()
+            rman_log.removeHandler(handler)
+
+    ret['output'] = list(output)
+    ret['phases'] = dict((name, {'elapsed': step['elapsed']}) for name, step in phases.items() if 'elapsed' in step)
+    ret['returncode'] = proc.returncode
+    ret['elapsed'] = _elapsed(start)
+    ret['result'] = proc.returncode == 0 and not failed
     if proc.returncode != 0:
        log.debug('RMAN failed with return code {}'.format(proc.returncode))
-       return False
+    _rman_event(sid, 'finish', dict((key, ret[key]) for key in ('result', 'returncode', 'errors', 'warnings', 'elapsed')))
 
-    return True
+    return ret
 
 def check_db_exists(sid, oracle_home=os.environ.get("ORACLE_HOME")):
 
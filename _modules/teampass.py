@@ -9,15 +9,25 @@ from __future__ import absolute_import, print_function, unicode_literals
 #from urlparse import quote_plus
 from salt.ext import six
 from salt.exceptions import CommandExecutionError
+import salt.utils.files
 import salt.utils.json
 import hmac
 import hashlib
 import time
+import random
+import threading
+import email.utils
+import base64
+import codecs
+import gzip
+import glob
 #import urllib
 import sys
+import os
 import re
 import json
 import logging
+from multiprocessing.pool import ThreadPool
 
 if sys.version_info >= (3, 0):
    from urllib.parse import quote_plus
@@ -27,10 +37,17 @@ if sys.version_info < (3, 0) and sys.version_info >= (2, 5):
 # Import third party libs
 try:
     import requests
+    from requests.adapters import HTTPAdapter
     HAS_LIBS = True
 except ImportError:
     HAS_LIBS = False
 
+try:
+    import msgpack
+    HAS_MSGPACK = True
+except ImportError:
+    HAS_MSGPACK = False
+
 
 log = logging.getLogger(__name__)
 
@@ -44,6 +61,183 @@ def __virtual__():
         return __virtualname__
     return (False, 'Team Password Manager module cannot be loaded: python requests library not available.')
 
+def _config(name, default=None):
+    '''
+    Return teampass.<name> from minion config or pillar
+    '''
+    return __salt__['config.get']('teampass.{0}'.format(name), default)
+
+def _credentials_fingerprint(conn_args):
+    '''
+    Return a digest identifying the credentials in conn_args,
+    so that credentials are never kept in clear text as a cache key.
+    '''
+    fingerprint = hashlib.sha256()
+    for key in ('username', 'password', 'public_key', 'private_key'):
+        fingerprint.update(six.text_type(conn_args.get(key, '')).encode('utf-8'))
+        fingerprint.update(b'\0')
+    return fingerprint.hexdigest()
+
+def _get_session(base_url, conn_args):
+    '''
+    Return a pooled keep-alive requests.Session for (base_url, credentials).
+    Sessions are kept in __context__, so they are reused by every call made
+    by this minion process instead of paying a TCP/TLS handshake per request.
+
+    Pool can be tuned in the minion config:
+        teampass.pool_connections: 4
+        teampass.pool_maxsize: 10
+        teampass.keep_alive: True
+    '''
+    sessions = __context__.setdefault('teampass.sessions', {})
+    key = (base_url, _credentials_fingerprint(conn_args))
+    if key not in sessions:
+        session = requests.Session()
+        session.verify = False
+        adapter = HTTPAdapter(pool_connections=int(_config('pool_connections', 4)),
+                              pool_maxsize=int(_config('pool_maxsize', 10)))
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        if not _config('keep_alive', True):
+            session.headers['Connection'] = 'close'
+        log.debug('Created new session for %s', base_url)
+        sessions[key] = session
+    return sessions[key]
+
+def _iter_json_array(chunks):
+    '''
+    Yield the items of a JSON array of objects read from byte chunks, one item at a time.
+    A stream that ends before the closing ] raises CommandExecutionError, so a truncated
+    body is not taken for a shorter list.
+    '''
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    started = False
+    for chunk in chunks:
+        buf += text.decode(chunk)
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buf):
+                break
+            if not started:
+                if buf[pos] != '[':
+                    raise CommandExecutionError('Response is not a JSON list')
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                item, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # Item is not complete yet, wait for the next chunk
+                break
+            yield item
+        buf = buf[pos:]
+    buf += text.decode(b'', final=True)
+    if buf.strip():
+        raise CommandExecutionError('Truncated JSON list, unparsed data left: %s' % buf.strip()[:80])
+    raise CommandExecutionError('Truncated JSON list, the closing ] is missing')
+
+def _project_fields(item, fields):
+    '''
+    Return the values of fields of item as a tuple, nested fields are dotted (project.name).
+    '''
+    values = []
+    for field in fields:
+        value = item
+        for key in field.split('.'):
+            value = value.get(key) if isinstance(value, dict) else None
+        values.append(value)
+    return tuple(values)
+
+# Responses worth retrying: throttled or temporarily unavailable server
+_RETRY_STATUS = (429, 500, 502, 503, 504)
+
+def _backoff(attempt, base, maximum):
+    '''
+    Return the delay before retry number attempt: exponential backoff with full jitter,
+    from base up to maximum seconds.
+    '''
+    ceiling = min(maximum, base * 2 ** attempt)
+    return random.uniform(0, ceiling)
+
+def _retry_after(req, maximum):
+    '''
+    Return the delay asked by the Retry-After header of a response (seconds or HTTP date),
+    capped to maximum seconds, or None.
+    '''
+    retry_after = req.headers.get('Retry-After')
+    if not retry_after:
+        return None
+    try:
+        delay = float(retry_after)
+    except ValueError:
+        date = email.utils.parsedate_tz(retry_after)
+        if date is None:
+            return None
+        delay = email.utils.mktime_tz(date) - time.time()
+    return min(max(delay, 0), maximum)
+
+class _TokenBucket(object):
+    '''
+       Client side rate limiter: up to burst requests at once, then rate requests per second.
+    '''
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.capacity = float(max(burst, 1))
+        self.tokens = self.capacity
+        self.time = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''Wait until a request is allowed.'''
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.time) * self.rate)
+                self.time = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def _rate_limiter(base_url):
+    '''
+    Return the rate limiter shared by all requests to base_url,
+    or None if teampass.max_rps is not set in the minion config.
+
+        teampass.max_rps: 10
+        teampass.burst: 20
+    '''
+    max_rps = float(_config('max_rps', 0) or 0)
+    if max_rps <= 0:
+        return None
+    limiters = __context__.setdefault('teampass.rate_limiters', {})
+    if base_url not in limiters:
+        limiters[base_url] = _TokenBucket(max_rps, int(_config('burst', max(max_rps, 1))))
+    return limiters[base_url]
+
+class _HmacSigner(object):
+    '''
+       HMAC-SHA256 signer of TPM requests.
+       The keyed context is computed once and copied for every request.
+    '''
+
+    def __init__(self, private_key):
+        self._hmac = hmac.new(private_key.encode('utf-8'), digestmod=hashlib.sha256)
+
+    def sign(self, message):
+        '''Return the hex digest of message.'''
+        signature = self._hmac.copy()
+        signature.update(message.encode('utf-8'))
+        return signature.hexdigest()
+
 class TpmApi(object):
     '''
        Settings needed for the connection to Team Password Manager.
@@ -58,16 +252,18 @@ class TpmApi(object):
     def __init__(self, base_url, kwargs):
 
         self.apiurl = 'api/' + 'v4' + '/'
-        log.debug('Set as apiurl: %s' % self.apiurl)
+        log.debug('Set as apiurl: %s', self.apiurl)
         self.api = self.apiurl
         self.base_url = base_url + '/index.php/'
-        log.debug('Set Base URL to %s' % self.base_url)
+        self.session = _get_session(base_url, kwargs)
+        self.fingerprint = _credentials_fingerprint(kwargs)
+        log.debug('Set Base URL to %s', self.base_url)
         self.url = self.base_url + self.apiurl
-        log.debug('Set URL to %s' % self.url)
+        log.debug('Set URL to %s', self.url)
 
-        # set headers
+        # set headers, they are copied and never changed by requests
         self.headers = {'Content-Type': 'application/json; charset=utf-8'}
-        log.debug('Set header to %s' % self.headers)
+        log.debug('Set header to %s', self.headers)
 
         # check kwargs for either keys or user credentials
         self.private_key   = False
@@ -90,14 +286,49 @@ class TpmApi(object):
         if self.private_key is not False and self.public_key is not False and\
                 self.username is False and self.password is False:
             log.debug('Using Private/Public Key authentication.')
+            self.signer = _HmacSigner(self.private_key)
+            self.auth = False
         elif self.username is not False and self.password is not False and\
                 self.private_key is False and self.public_key is False:
             log.debug('Using Basic authentication.')
+            self.signer = None
+            self.auth = requests.auth.HTTPBasicAuth(self.username, self.password)
         else:
             raise CommandExecutionError('No authentication specified (user/password or private/public key)')
 
-    def request(self, path, action, data=''):
-        '''To make a request to the API.'''
+        # Worker threads do not see the loader globals (__salt__, __context__) on
+        # Salt 3003+, so the settings used by _send are resolved here, in the caller
+        self.retry_post = _config('retry_post', False)
+        self.max_retries = int(_config('max_retries', 3))
+        self.backoff_base = float(_config('backoff_base', 0.5))
+        self.backoff_max = float(_config('backoff_max', 30))
+        self.limiter = _rate_limiter(self.base_url)
+        # and so are those of the response cache, used by get_many workers
+        self.response_cache = _config('response_cache', True)
+        self.cache_ttl = float(_config('cache_ttl', 0))
+        self.cachedir = __opts__['cachedir']
+        self.cache_stats = __context__.setdefault('teampass.cache_stats', {'hits': 0, 'misses': 0})
+
+    def _headers(self, path, data, headers=None):
+        '''Build the headers of one request, without changing the shared ones.'''
+        request_headers = dict(self.headers)
+        # In case of key authentication
+        if self.signer is not None:
+            timestamp = str(int(time.time()))
+            request_headers['X-Public-Key'] = self.public_key
+            request_headers['X-Request-Hash'] = self.signer.sign(path + timestamp + data)
+            request_headers['X-Request-Timestamp'] = timestamp
+            log.debug('Signed %s with timestamp %s', path, timestamp)
+        # Set unlock reason
+        if self.unlock_reason:
+            request_headers['X-Unlock-Reason'] = self.unlock_reason
+            log.info('Unlock Reason: %s', self.unlock_reason)
+        if headers:
+            request_headers.update(headers)
+        return request_headers
+
+    def _path(self, path):
+        '''Return path relative to the base URL, starting with the API version.'''
         # Check if the path includes URL or not.
         head = self.base_url
         if path.startswith(head):
@@ -106,73 +337,103 @@ class TpmApi(object):
             path = quote_plus(path, safe='/')
         if not path.startswith(self.api):
             path = self.api + path
-        log.debug('Using path %s' % path)
+        log.debug('Using path %s', path)
+        return path
+
+    def _request(self, path, action, data='', headers=None):
+        '''
+           To make a request to the API, safe to call from many threads.
+           Returns the result and the response.
+        '''
+        path = self._path(path)
+        head = self.base_url
 
         # If we have data, convert to JSON
         if data:
             data = json.dumps(data)
-            log.debug('Data to sent: %s' % data)
-        # In case of key authentication
-        if self.private_key and self.public_key:
-            timestamp = str(int(time.time()))
-            log.debug('Using timestamp: {}'.format(timestamp))
-            unhashed = path + timestamp + str(data)
-            log.debug('Using message: {}'.format(unhashed))
-            self.hash = hmac.new(str.encode(self.private_key), msg=unhashed.encode('utf-8'), digestmod=hashlib.sha256).hexdigest()
-            log.debug('Authenticating with hash: %s' % self.hash)
-            self.headers['X-Public-Key'] = self.public_key
-            self.headers['X-Request-Hash'] = self.hash
-            self.headers['X-Request-Timestamp'] = timestamp
-            auth = False
-        # In case of user credentials authentication
-        elif self.username and self.password:
-            auth = requests.auth.HTTPBasicAuth(self.username, self.password)
-        # Set unlock reason
-        if self.unlock_reason:
-            self.headers['X-Unlock-Reason'] = self.unlock_reason
-            log.info('Unlock Reason: %s' % self.unlock_reason)
+            log.debug('Data to sent: %s', data)
+        else:
+            data = ''
         url = head + path
+        # A change of an item makes its cached response stale
+        if action != 'get':
+            self._drop_cached(path)
         # Try API request and handle Exceptions
+        req = None
         try:
-            if action == 'get':
-                log.debug('GET request %s' % url)
-                self.req = requests.get(url, headers=self.headers, auth=auth, verify=False)
-            elif action == 'post':
-                log.debug('POST request %s' % url)
-                self.req = requests.post(url, headers=self.headers, auth=auth,verify=False, data=data)
-            elif action == 'put':
-                log.debug('PUT request %s' % url)
-                self.req = requests.put(url, headers=self.headers, auth=auth, verify=False, data=data)
-            elif action == 'delete':
-                log.debug('DELETE request %s' % url)
-                self.req = requests.delete(url, headers=self.headers, verify=False, auth=auth)
-
-            if self.req.content == b'':
+            req = self._send(action, path, data, headers)
+
+            if req.content == b'':
                 result = None
                 log.debug('No result returned.')
-                #log.debug('Response status code is:' + self.req.status_code)
             else:
-                result = self.req.json()
-                #log.debug('Response status code is:' + self.req.status_code)
+                result = req.json()
                 if 'error' in result and result['error']:
                     raise CommandExecutionError(result['message'])
 
         except requests.exceptions.RequestException as e:
-            log.critical("Connection error for " + str(e))
+            log.critical('Connection error for %s', e)
             raise CommandExecutionError("Connection error for " + str(e))
 
         except ValueError as e:
-            if self.req.status_code == 403:
-                log.warning(url + " forbidden")
+            if req.status_code == 403:
+                log.warning('%s forbidden', url)
                 raise CommandExecutionError(url + " forbidden")
-            elif self.req.status_code == 404:
-                log.warning(url + " forbidden")
+            elif req.status_code == 404:
+                log.warning('%s not found', url)
                 raise CommandExecutionError(url + " not found")
             else:
-                message = ('%s: %s %s' % (e, self.req.url, self.req.text))
+                message = ('%s: %s %s' % (e, req.url, req.text))
                 log.debug(message)
                 raise ValueError(message)
 
+        return result, req
+
+    def _send(self, action, path, data, headers=None, stream=False):
+        '''
+           Send a request once the rate limiter allows it.
+           Throttled (429), unavailable (5xx) and failed connections are retried with
+           exponential backoff and jitter (teampass.backoff_base, default 0.5s, up to
+           teampass.backoff_max, default 30s), honoring Retry-After. POST requests are not
+           idempotent and are only retried if teampass.retry_post is True.
+           Only attributes resolved in __init__ are used, it runs in get_many workers.
+        '''
+        url = self.base_url + path
+        if action == 'post' and not self.retry_post:
+            max_retries = 0
+        else:
+            max_retries = self.max_retries
+        limiter = self.limiter
+        attempt = 0
+        while True:
+            if limiter is not None:
+                limiter.acquire()
+            # Headers are signed again, the timestamp is part of the hash
+            request_headers = self._headers(path, data, headers)
+            log.debug('%s request %s', action.upper(), url)
+            try:
+                req = self.session.request(action.upper(), url, headers=request_headers, auth=self.auth,
+                                           verify=False, data=data if action in ('post', 'put') else None,
+                                           stream=stream)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= max_retries:
+                    raise
+                delay = _backoff(attempt, self.backoff_base, self.backoff_max)
+                log.warning('%s request %s failed (%s), retry in %.1fs', action.upper(), url, e, delay)
+            else:
+                if req.status_code not in _RETRY_STATUS or attempt >= max_retries:
+                    return req
+                delay = _retry_after(req, self.backoff_max)
+                if delay is None:
+                    delay = _backoff(attempt, self.backoff_base, self.backoff_max)
+                log.warning('%s request %s returned %s, retry in %.1fs', action.upper(), url, req.status_code, delay)
+                req.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def request(self, path, action, data='', headers=None):
+        '''To make a request to the API.'''
+        result, self.req = self._request(path, action, data, headers)
         return result
 
     def post(self, path, data=''):
@@ -183,6 +444,93 @@ class TpmApi(object):
         '''For get based requests.'''
         return self.request(path, 'get')
 
+    def _cache_file(self, path):
+        '''Return the on-disk cache file of a response, keyed by path and credentials.'''
+        if not path.startswith(self.api):
+            path = self.api + path
+        key = hashlib.sha256((self.base_url + path + self.fingerprint).encode('utf-8')).hexdigest()
+        return os.path.join(self.cachedir, 'teampass', 'http', key + '.json')
+
+    def _drop_cached(self, path):
+        '''Remove the cached response of the item a path belongs to.'''
+        if path.startswith(self.api):
+            path = path[len(self.api):]
+        item = re.match(r'(projects|passwords|users|groups)/(\d+)', path)
+        if item and item.group(1) == 'passwords':
+            _drop_secret(self.base_url, item.group(2))
+        if item:
+            cache_file = self._cache_file('%s/%s.json' % item.groups())
+            if os.path.exists(cache_file):
+                os.remove(cache_file)
+
+    def get_cached(self, path):
+        '''
+           For get based requests, revalidated against an on-disk response cache.
+
+           Responses are stored under <cachedir>/teampass/http with their ETag and Last-Modified.
+           A cached response is revalidated with If-None-Match/If-Modified-Since,
+           or served for teampass.cache_ttl seconds when the server sent no validators.
+           TPM sends no validators, and teampass.cache_ttl defaults to 0: a response is only
+           stored, and served without a request, if a TTL is set, accepting changes made meanwhile
+           are not seen. Set teampass.response_cache to False to disable the cache.
+        '''
+        if not self.response_cache:
+            return self._request(path, 'get')[0]
+
+        stats = self.cache_stats
+        cache_file = self._cache_file(path)
+        entry = None
+        if os.path.exists(cache_file):
+            try:
+                with salt.utils.files.fopen(cache_file, 'r') as fp_:
+                    entry = json.load(fp_)
+            except (IOError, OSError, ValueError) as e:
+                log.debug('Ignore unreadable cache file %s: %s', cache_file, e)
+
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+            if not headers and time.time() - entry['time'] < self.cache_ttl:
+                stats['hits'] += 1
+                return entry['body']
+
+        result, req = self._request(path, 'get', headers=headers)
+        if entry is not None and req.status_code == 304:
+            stats['hits'] += 1
+            log.debug('Not modified, using cached response of %s', path)
+            return entry['body']
+
+        etag = req.headers.get('ETag')
+        last_modified = req.headers.get('Last-Modified')
+        if not etag and not last_modified and self.cache_ttl <= 0:
+            # Nothing to revalidate or serve it with, storing it would only cost disk I/O
+            if entry is not None:
+                try:
+                    os.remove(cache_file)
+                except OSError:
+                    pass
+            return result
+
+        stats['misses'] += 1
+        entry = {'time': time.time(),
+                 'etag': etag,
+                 'last_modified': last_modified,
+                 'body': result}
+        try:
+            cache_dir = os.path.dirname(cache_file)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0o700)
+            tmp_file = cache_file + '.tmp'
+            with os.fdopen(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as fp_:
+                json.dump(entry, fp_)
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError) as e:
+            log.warning('Can not write cache file %s: %s', cache_file, e)
+        return result
+
     def put(self, path, data=''):
         '''For put based requests.'''
         return self.request(path, 'put', data)
@@ -191,30 +539,292 @@ class TpmApi(object):
         '''For delete based requests.'''
         return self.request(path, 'delete')
 
-    def get_collection(self, path):
-        '''To get pagewise data.'''
-        while True:
-            items = self.get(path)
-            req = self.req
+    def _num_pages(self, path):
+        '''Return the number of pages of a collection, or None if it can not be counted.'''
+        try:
+            count, req = self._request(re.sub(r'\.json$', '/count.json', path), 'get')
+            return int(count['num_pages'])
+        except (CommandExecutionError, ValueError, KeyError, TypeError) as e:
+            log.debug('Can not count pages of %s: %s', path, e)
+            return None
+
+    def _get_page(self, path):
+        '''To get one page of a collection, safe to call from a worker thread.'''
+        return self._request(path, 'get')[0] or []
+
+    def get_many(self, paths, concurrency=None, cached=False):
+        '''
+           To get many items at the same time over the pooled session.
+
+           paths       : List of paths to get
+           concurrency : Number of requests in flight, default is teampass.fan_out_concurrency
+                         from minion config, or teampass.pool_maxsize (10)
+           cached      : If True, requests go through the response cache (see get_cached)
+
+           Returns the results in the order of paths.
+        '''
+        paths = list(paths)
+        if not paths:
+            return []
+        if concurrency is None:
+            concurrency = int(_config('fan_out_concurrency', _config('pool_maxsize', 10)))
+
+        def _get(path):
+            if cached:
+                return self.get_cached(path)
+            return self._request(path, 'get')[0]
+
+        pool = ThreadPool(max(1, min(concurrency, len(paths))))
+        try:
+            return pool.map(_get, paths)
+        finally:
+            pool.close()
+            pool.join()
+
+    def get_collection(self, path, concurrency=None):
+        '''
+           To get pagewise data.
+
+           concurrency : Number of pages fetched at the same time once the number of pages is known.
+                         Default is teampass.page_concurrency from minion config (1, pages are walked one by one).
+                         Items are always yielded in page order.
+        '''
+        if concurrency is None:
+            concurrency = int(_config('page_concurrency', 1))
+
+        items, req = self._request(path, 'get')
+        for item in items:
+            yield item
+
+        if not (req.links and 'next' in req.links):
+            return
+
+        if concurrency > 1 and not path.startswith(self.base_url):
+            num_pages = self._num_pages(path)
+            if num_pages and num_pages > 1:
+                page_path = re.sub(r'\.json$', '', path) + '/page/%s.json'
+                pages = [page_path % page for page in range(2, num_pages + 1)]
+                log.debug('Fetch %s pages of %s with %s workers', len(pages), path, concurrency)
+                pool = ThreadPool(min(concurrency, len(pages)))
+                try:
+                    for items in pool.imap(self._get_page, pages):
+                        for item in items:
+                            yield item
+                finally:
+                    pool.terminate()
+                return
+
+        while req.links and req.links['next'] and\
+                req.links['next']['rel'] == 'next':
+            path = req.links['next']['url']
+            items, req = self._request(path, 'get')
             for item in items:
                 yield item
-            if req.links and req.links['next'] and\
-                    req.links['next']['rel'] == 'next':
-                path = req.links['next']['url']
-            else:
-                break
 
-    def collection(self, path):
+    def iter_collection(self, path, chunk_size=65536):
+        '''
+           To iterate over a collection, page by page, decoding each page body incrementally
+           as it is received, so neither a page nor the collection is held in memory.
+        '''
+        while path:
+            try:
+                req = self._send('get', self._path(path), '', stream=True)
+            except requests.exceptions.RequestException as e:
+                log.critical('Connection error for %s', e)
+                raise CommandExecutionError("Connection error for " + str(e))
+            try:
+                if req.status_code >= 400:
+                    raise CommandExecutionError('%s returned %s' % (req.url, req.status_code))
+                try:
+                    for item in _iter_json_array(req.iter_content(chunk_size)):
+                        yield item
+                except requests.exceptions.RequestException as e:
+                    log.critical('Connection error for %s', e)
+                    raise CommandExecutionError("Connection error for " + str(e))
+                path = None
+                if req.links and 'next' in req.links and req.links['next']['rel'] == 'next':
+                    path = req.links['next']['url']
+            finally:
+                req.close()
+
+    def collection(self, path, concurrency=None):
         '''To return all items generated by get collection.'''
         data = []
-        for item in self.get_collection(path):
+        for item in self.get_collection(path, concurrency):
             data.append(item)
         return data
 
-def _exact_match(data_list, field, value):
-    match = filter(lambda data: value == data[field] , data_list)
+def _exact_search(tpmconn, path, value, field='name', limit=None):
+    '''
+    Return the items of the search collection path whose field equals value.
+    TPM is asked for a field qualified search (name:"value") so that only close hits are paged,
+    and no more pages are fetched once limit exact hits are found.
+    '''
+    if '"' in value:
+        searchstring = value
+    else:
+        searchstring = '%s:"%s"' % (field, value)
+    match = []
+    for item in tpmconn.get_collection('%s/search/%s.json' % (path, quote_plus(searchstring)), concurrency=1):
+        if item.get(field) == value:
+            match.append(item)
+            if limit is not None and len(match) >= limit:
+                break
     return match
 
+# Fields indexed in the users/groups directory snapshot
+_DIRECTORY_FIELDS = {
+    'users': ('id', 'name', 'username', 'email_address'),
+    'groups': ('id', 'name'),
+}
+_DIRECTORY_ALIASES = {'email': 'email_address'}
+
+def _directory(kind, base_url, conn_args):
+    '''
+    Return the users or groups snapshot of TPM with dict indexes by field.
+    The snapshot is kept in __context__ for teampass.directory_ttl seconds (default 60),
+    so a state run doing many lookups downloads the directory only once.
+    '''
+    cache = __context__.setdefault('teampass.directory', {})
+    key = (kind, base_url, _credentials_fingerprint(conn_args))
+    snapshot = cache.get(key)
+    if snapshot is None or time.time() - snapshot['time'] > float(_config('directory_ttl', 60)):
+        tpmconn = TpmApi(base_url, conn_args)
+        log.debug('Download %s directory', kind)
+        items = tpmconn.collection('%s.json' % kind)
+        indexes = {}
+        for field in _DIRECTORY_FIELDS[kind]:
+            index = indexes[field] = {}
+            for item in items:
+                if field in item:
+                    index.setdefault(item[field], []).append(item)
+        snapshot = {'time': time.time(), 'items': items, 'indexes': indexes}
+        cache[key] = snapshot
+    return snapshot
+
+def _invalidate_directory(kind, base_url, conn_args):
+    '''
+    Drop the users or groups snapshot after a change in TPM.
+    '''
+    cache = __context__.get('teampass.directory', {})
+    cache.pop((kind, base_url, _credentials_fingerprint(conn_args)), None)
+
+def _directory_lookup(kind, field, value, base_url, conn_args):
+    field = _DIRECTORY_ALIASES.get(field, field)
+    snapshot = _directory(kind, base_url, conn_args)
+    if field in snapshot['indexes']:
+        return list(snapshot['indexes'][field].get(value, []))
+    return [item for item in snapshot['items'] if item.get(field) == value]
+
+def _secret_crypticle():
+    '''
+    Return the cipher of the on-disk secret cache, with a key derived from the minion private key,
+    or None if it can not be built (then secrets are only cached in memory).
+    '''
+    if 'teampass.secret_crypticle' not in __context__:
+        crypticle = None
+        try:
+            import salt.crypt
+            with salt.utils.files.fopen(os.path.join(__opts__['pki_dir'], 'minion.pem'), 'rb') as fp_:
+                key = hashlib.pbkdf2_hmac('sha256', fp_.read(), b'teampass-secret-cache', 10000, 56)
+            crypticle = salt.crypt.Crypticle(__opts__, base64.b64encode(key))
+        except (ImportError, IOError, OSError, KeyError) as e:
+            log.warning('Encrypted teampass secret cache is disabled: %s', e)
+        __context__['teampass.secret_crypticle'] = crypticle
+    return __context__['teampass.secret_crypticle']
+
+def _secret_file(base_url, id, fingerprint=None):
+    '''
+    Return the on-disk secret cache file of a password, or its glob for all credentials.
+    '''
+    prefix = hashlib.sha256(('%s|%s' % (base_url, id)).encode('utf-8')).hexdigest()
+    suffix = fingerprint[:16] if fingerprint else '*'
+    return os.path.join(__opts__['cachedir'], 'teampass', 'secrets', '%s.%s.bin' % (prefix, suffix))
+
+def _secret_stats():
+    return __context__.setdefault('teampass.secret_cache_stats', {'hits': 0, 'misses': 0, 'bytes_saved': 0})
+
+def _secret_get(tpmconn, id):
+    '''
+    Return a cached password record younger than teampass.secret_cache_ttl seconds (default 60), or None.
+    '''
+    entries = __context__.setdefault('teampass.secrets', {}).setdefault((tpmconn.base_url, six.text_type(id)), {})
+    entry = entries.get(tpmconn.fingerprint)
+    if entry is None and _config('secret_cache_disk', False):
+        crypticle = _secret_crypticle()
+        secret_file = _secret_file(tpmconn.base_url, id, tpmconn.fingerprint)
+        if crypticle is not None and os.path.exists(secret_file):
+            try:
+                with salt.utils.files.fopen(secret_file, 'rb') as fp_:
+                    entry = crypticle.loads(fp_.read())
+                entries[tpmconn.fingerprint] = entry
+            except Exception as e:  # pylint: disable=broad-except
+                log.debug('Ignore unreadable secret cache file %s: %s', secret_file, e)
+                entry = None
+    if entry is None or time.time() - entry['time'] >= float(_config('secret_cache_ttl', 60)):
+        return None
+    stats = _secret_stats()
+    stats['hits'] += 1
+    stats['bytes_saved'] += entry['size']
+    return entry['record']
+
+def _secret_put(tpmconn, id, record):
+    '''
+    Keep a password record in memory, and encrypted on disk if teampass.secret_cache_disk is True.
+    '''
+    entry = {'time': time.time(), 'record': record, 'size': len(json.dumps(record))}
+    entries = __context__.setdefault('teampass.secrets', {}).setdefault((tpmconn.base_url, six.text_type(id)), {})
+    entries[tpmconn.fingerprint] = entry
+    if not _config('secret_cache_disk', False):
+        return
+    crypticle = _secret_crypticle()
+    if crypticle is None:
+        return
+    secret_file = _secret_file(tpmconn.base_url, id, tpmconn.fingerprint)
+    try:
+        secret_dir = os.path.dirname(secret_file)
+        if not os.path.isdir(secret_dir):
+            os.makedirs(secret_dir, 0o700)
+        tmp_file = secret_file + '.tmp'
+        with os.fdopen(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as fp_:
+            fp_.write(crypticle.dumps(entry))
+        os.rename(tmp_file, secret_file)
+    except (IOError, OSError) as e:
+        log.warning('Can not write secret cache file %s: %s', secret_file, e)
+
+def _drop_secret(base_url, id):
+    '''
+    Forget a password record for every credential, in memory and on disk.
+    '''
+    __context__.get('teampass.secrets', {}).pop((base_url, six.text_type(id)), None)
+    for secret_file in glob.glob(_secret_file(base_url, id)):
+        try:
+            os.remove(secret_file)
+        except OSError:
+            pass
+
+def _show_secrets(tpmconn, ids, concurrency=None):
+    '''
+    Return password records by id, read through the secret cache.
+    '''
+    records = {}
+    missing = []
+    for id in ids:
+        record = _secret_get(tpmconn, id)
+        if record is None:
+            missing.append(id)
+        else:
+            records[id] = record
+    _secret_stats()['misses'] += len(missing)
+    if len(missing) == 1:
+        fetched = [tpmconn.get('passwords/%s.json' % missing[0])]
+    else:
+        fetched = tpmconn.get_many(['passwords/%s.json' % id for id in missing], concurrency)
+    for id, record in zip(missing, fetched):
+        _secret_put(tpmconn, id, record)
+        records[id] = record
+    return records
+
 def list_projects(base_url, **conn_args):
     '''
        List projects:
@@ -271,7 +881,7 @@ def list_projects_favorite(base_url, **conn_args):
     log.debug('List all favorite projects.')
     return tpmconn.collection('projects/favorite.json')
 
-def list_projects_search(base_url, searchstring, exact_match = False, **conn_args):
+def list_projects_search(base_url, searchstring, exact_match = False, limit = None, **conn_args):
     '''
        List projects with searchstring.
        API Doc URL : https://teampasswordmanager.com/docs/api-projects/#list_projects
@@ -279,6 +889,9 @@ def list_projects_search(base_url, searchstring, exact_match = False, **conn_arg
 
        Args:
        base_url    : Your Team Password Manager URL
+       searchstring: Search String
+       exact_match : If True, only projects named searchstring are returned
+       limit       : With exact_match, stop searching once limit projects are found
        **conn_args : (Method: 1)  For HTTP Basic Authentication pass conn_args as username and password
                      (Method: 2)  For HMAC Authentication pass conn_args as private_key and public_key
 
@@ -287,14 +900,12 @@ def list_projects_search(base_url, searchstring, exact_match = False, **conn_arg
 
     tpmconn = TpmApi(base_url, conn_args)
     log.debug('List all projects with: %s' % searchstring)
-    projects = tpmconn.collection('projects/search/%s.json' % quote_plus(searchstring))
+    if exact_match:
+       return _exact_search(tpmconn, 'projects', searchstring, limit=limit)
+    return tpmconn.collection('projects/search/%s.json' % quote_plus(searchstring))
 
-    if exact_match == False:
-       return projects
-    return _exact_match(projects, 'name', searchstring)
 
-
-def show_project(base_url, id, **conn_args):
+def show_project(base_url, id, cached=True, **conn_args):
     '''
        Show a project.
        API Doc URL : https://teampasswordmanager.com/docs/api-projects/#show_project
@@ -302,6 +913,7 @@ def show_project(base_url, id, **conn_args):
 
        Args:
        base_url    : Your Team Password Manager URL
+       cached      : If False, the project is read from TPM and not from the response cache
        **conn_args : (Method: 1)  For HTTP Basic Authentication pass conn_args as username and password
                      (Method: 2)  For HMAC Authentication pass conn_args as private_key and public_key
 
@@ -310,7 +922,31 @@ def show_project(base_url, id, **conn_args):
 
     tpmconn = TpmApi(base_url, conn_args)
     log.debug('Show project info: %s' % id)
-    return tpmconn.get('projects/%s.json' % id)
+    if not cached:
+        return tpmconn.get('projects/%s.json' % id)
+    return tpmconn.get_cached('projects/%s.json' % id)
+
+def show_projects_many(base_url, ids, concurrency=None, cached=True, **conn_args):
+    '''
+       Show many projects at the same time.
+       API Doc URL : https://teampasswordmanager.com/docs/api-projects/#show_project
+       Auth Doc URL: https://teampasswordmanager.com/docs/api-authentication/
+
+       Args:
+       base_url    : Your Team Password Manager URL
+       ids         : List of internal ids of the projects
+       concurrency : Number of requests in flight (default teampass.fan_out_concurrency)
+       cached      : If False, the projects are read from TPM and not from the response cache
+       **conn_args : (Method: 1)  For HTTP Basic Authentication pass conn_args as username and password
+                     (Method: 2)  For HMAC Authentication pass conn_args as private_key and public_key
+
+       returns a dict of the data of each project by internal id.
+    '''
+
+    tpmconn = TpmApi(base_url, conn_args)
+    log.debug('Show %s projects' % len(ids))
+    projects = tpmconn.get_many(['projects/%s.json' % id for id in ids], concurrency, cached=cached)
+    return dict(zip(ids, projects))
 
 def list_passwords_of_project(base_url, id, **conn_args):
     '''
@@ -567,6 +1203,35 @@ def list_passwords(base_url, **conn_args):
     log.debug('List all passwords.')
     return tpmconn.collection('passwords.json')
 
+def iter_passwords(base_url, fields=None, searchstring=None, **conn_args):
+    '''
+       Iterate over passwords without building the list of all of them.
+       API Doc URL : https://teampasswordmanager.com/docs/api-passwords/#list_passwords
+       Auth Doc URL: https://teampasswordmanager.com/docs/api-authentication/
+
+       Args:
+       base_url    : Your Team Password Manager URL
+       fields      : Optional list of fields to keep, nested fields are dotted (ex: ['id', 'name', 'project.name']).
+                     Each password is then yielded as a tuple of these values.
+       searchstring: Optional search string, to iterate over search results only
+       **conn_args : (Method: 1)  For HTTP Basic Authentication pass conn_args as username and password
+                     (Method: 2)  For HMAC Authentication pass conn_args as private_key and public_key
+
+       yields the passwords that the user has access to, as pages are received.
+    '''
+
+    tpmconn = TpmApi(base_url, conn_args)
+    if searchstring is None:
+        path = 'passwords.json'
+    else:
+        path = 'passwords/search/%s.json' % quote_plus(searchstring)
+    log.debug('Iterate over passwords of %s', path)
+    for password in tpmconn.iter_collection(path):
+        if fields:
+            yield _project_fields(password, fields)
+        else:
+            yield password
+
 def list_passwords_archived(base_url, **conn_args):
     '''
        List archived passwords.
@@ -602,7 +1267,7 @@ def list_passwords_favorite(base_url, **conn_args):
     log.debug('List favorite spasswords.')
     return tpmconn.collection('passwords/favorite.json')
 
-def list_passwords_search(base_url, searchstring, exact_match = False, **conn_args):
+def list_passwords_search(base_url, searchstring, exact_match = False, limit = None, **conn_args):
     '''
        List passwords with searchstring.
        API Doc URL : https://teampasswordmanager.com/docs/api-passwords/#list_passwords
@@ -612,6 +1277,8 @@ def list_passwords_search(base_url, searchstring, exact_match = False, **conn_ar
        Args:
        base_url    : Your Team Password Manager URL
        searchstring: Search String
+       exact_match : If True, only passwords named searchstring are returned
+       limit       : With exact_match, stop searching once limit passwords are found
        **conn_args : (Method: 1)  For HTTP Basic Authentication pass conn_args as username and password
                      (Method: 2)  For HMAC Authentication pass conn_args as private_key and public_key
 
@@ -622,11 +1289,9 @@ def list_passwords_search(base_url, searchstring, exact_match = False, **conn_ar
 
     tpmconn = TpmApi(base_url, conn_args)
     log.debug('List all passwords with: %s' % searchstring)
-    passwords = tpmconn.collection('passwords/search/%s.json' % quote_plus(searchstring))
-
-    if exact_match == False:
-       return passwords
-    return _exact_match(passwords, 'name', searchstring)
+    if exact_match:
+       return _exact_search(tpmconn, 'passwords', searchstring, limit=limit)
+    return tpmconn.collection('passwords/search/%s.json' % quote_plus(searchstring))
 
 def show_password(base_url, id, **conn_args):
     '''
@@ -645,7 +1310,27 @@ def show_password(base_url, id, **conn_args):
 
     tpmconn = TpmApi(base_url, conn_args)
     log.info('Show password info: %s' % id)
-    return tpmconn.get('passwords/%s.json' % id)
+    return _show_secrets(tpmconn, [id])[id]
+
+def show_passwords_many(base_url, ids, concurrency=None, **conn_args):
+    '''
+       Show many passwords at the same time.
+       API Doc URL : https://teampasswordmanager.com/docs/api-passwords/#show_password
+       Auth Doc URL: https://teampasswordmanager.com/docs/api-authentication/
+
+       Args:
+       base_url    : Your Team Password Manager URL
+       ids         : List of internal ids of the passwords
+       concurrency : Number of requests in flight (default teampass.fan_out_concurrency)
+       **conn_args : (Method: 1)  For HTTP Basic Authentication pass conn_args as username and password
+                     (Method: 2)  For HMAC Authentication pass conn_args as private_key and public_key
+
+       returns a dict of the data of each password by internal id.
+    '''
+
+    tpmconn = TpmApi(base_url, conn_args)
+    log.info('Show %s passwords' % len(ids))
+    return _show_secrets(tpmconn, ids, concurrency)
 
 def list_user_access_on_password(base_url, id, **conn_args):
     '''
@@ -881,7 +1566,7 @@ def list_mypasswords(base_url, **conn_args):
     log.debug('List MyPasswords')
     return tpmconn.collection('my_passwords.json')
 
-def list_mypasswords_search(base_url, searchstring, exact_match = False, **conn_args):
+def list_mypasswords_search(base_url, searchstring, exact_match = False, limit = None, **conn_args):
     '''
        List my passwords with searchstring.
        API Doc URL : https://teampasswordmanager.com/docs/api-my-passwords/#list_passwords
@@ -890,6 +1575,8 @@ def list_mypasswords_search(base_url, searchstring, exact_match = False, **conn_
        Args:
        base_url    : Your Team Password Manager URL
        searchstring: Search String
+       exact_match : If True, only my passwords named searchstring are returned
+       limit       : With exact_match, stop searching once limit my passwords are found
        **conn_args : (Method: 1)  For HTTP Basic Authentication pass conn_args as username and password
                      (Method: 2)  For HMAC Authentication pass conn_args as private_key and public_key
 
@@ -899,11 +1586,9 @@ def list_mypasswords_search(base_url, searchstring, exact_match = False, **conn_
 
     tpmconn = TpmApi(base_url, conn_args)
     log.debug('List MyPasswords with %s' % searchstring)
-    mypasswords = tpmconn.collection('my_passwords/search/%s.json' % quote_plus(searchstring))
-
-    if exact_match == False:
-       return mypasswords
-    return _exact_match(mypasswords, 'name', searchstring)
+    if exact_match:
+       return _exact_search(tpmconn, 'my_passwords', searchstring, limit=limit)
+    return tpmconn.collection('my_passwords/search/%s.json' % quote_plus(searchstring))
 
 def show_mypassword(base_url, id, **conn_args):
     '''
@@ -1108,17 +1793,18 @@ def list_users(base_url, **conn_args):
        If successful, the response code is 200 OK with the results of the call in the response body.
     '''
 
-    tpmconn = TpmApi(base_url, conn_args)
     log.debug('List users')
-    return tpmconn.collection('users.json')
+    return list(_directory('users', base_url, conn_args)['items'])
 
 
 def get_user_by(field, value, base_url, **conn_args):
-    users = list_users(base_url, **conn_args)
-    user = _exact_match(users, field, value)
-    return user
+    '''
+       Return the list of users whose field (id, name, username or email) equals value.
+       Lookups are served from the cached users directory.
+    '''
+    return _directory_lookup('users', field, value, base_url, conn_args)
 
-def show_user(base_url, id, **conn_args):
+def show_user(base_url, id, cached=True, **conn_args):
     '''
        Show a user.
        API Doc URL : https://teampasswordmanager.com/docs/api-users/#show_user
@@ -1127,6 +1813,7 @@ def show_user(base_url, id, **conn_args):
        Args:
        base_url    : Your Team Password Manager URL
        id          : Internal id of the user.
+       cached      : If False, the user is read from TPM and not from the response cache
        **conn_args : (Method: 1)  For HTTP Basic Authentication pass conn_args as username and password
                      (Method: 2)  For HMAC Authentication pass conn_args as private_key and public_key
 
@@ -1135,7 +1822,9 @@ def show_user(base_url, id, **conn_args):
 
     tpmconn = TpmApi(base_url, conn_args)
     log.debug('Show user %s' % id)
-    return tpmconn.get('users/%s.json' % id)
+    if not cached:
+        return tpmconn.get('users/%s.json' % id)
+    return tpmconn.get_cached('users/%s.json' % id)
 
 def show_me(base_url, **conn_args):
     '''
@@ -1186,6 +1875,7 @@ def create_user(base_url, data, **conn_args):
     tpmconn = TpmApi(base_url, conn_args)
     log.info('Create user with %s' % data)
     new_id = tpmconn.post('users.json', data).get('id')
+    _invalidate_directory('users', base_url, conn_args)
     log.info('User has been created with id %s' % new_id)
     return new_id
 
@@ -1216,6 +1906,7 @@ def update_user(base_url, id, data, **conn_args):
     tpmconn = TpmApi(base_url, conn_args)
     log.info('Update user %s with %s' % (id, data))
     tpmconn.put('users/%s.json' % id, data)
+    _invalidate_directory('users', base_url, conn_args)
 
     return True
 
@@ -1262,6 +1953,7 @@ def activate_user(base_url, id, **conn_args):
     tpmconn = TpmApi(base_url, conn_args)
     log.info('Activate user %s' % id)
     tpmconn.put('users/%s/activate.json' % id)
+    _invalidate_directory('users', base_url, conn_args)
 
     return True
 
@@ -1283,6 +1975,7 @@ def deactivate_user(base_url, id, **conn_args):
     tpmconn = TpmApi(base_url, conn_args)
     log.info('Deactivate user %s' % id)
     tpmconn.put('users/%s/deactivate.json' % id)
+    _invalidate_directory('users', base_url, conn_args)
 
     return True
 
@@ -1306,6 +1999,7 @@ def convert_user_to_ldap(base_url, id, DN, **conn_args):
     data = {'login_dn': DN}
     log.info('Convert User %s to LDAP DN %s' % (id, DN))
     tpmconn.put('users/%s/convert_to_ldap.json' % id, data)
+    _invalidate_directory('users', base_url, conn_args)
 
     return True
 
@@ -1327,6 +2021,7 @@ def convert_ldap_user_to_normal(base_url, id, **conn_args):
     tpmconn = TpmApi(base_url, conn_args)
     log.info('Convert User %s from LDAP to normal user' % id)
     tpmconn.put('users/%s/convert_to_normal.json' % id)
+    _invalidate_directory('users', base_url, conn_args)
 
     return True
 
@@ -1348,6 +2043,7 @@ def delete_user(base_url, id, **conn_args):
     tpmconn = TpmApi(base_url, conn_args)
     log.info('Delete user %s' % id)
     tpmconn.delete('users/%s.json' % id)
+    _invalidate_directory('users', base_url, conn_args)
 
     return True
 
@@ -1365,16 +2061,17 @@ def list_groups(base_url, **conn_args):
        If successful, the response code is 200 OK with the results of the call in the response body.
     '''
 
-    tpmconn = TpmApi(base_url, conn_args)
     log.debug('List groups')
-    return tpmconn.collection('groups.json')
+    return list(_directory('groups', base_url, conn_args)['items'])
 
 def get_group_by(field, value, base_url, **conn_args):
-    groups = list_groups(base_url, **conn_args)
-    group  = _exact_match(groups, field, value)
-    return group
+    '''
+       Return the list of groups whose field (id or name) equals value.
+       Lookups are served from the cached groups directory.
+    '''
+    return _directory_lookup('groups', field, value, base_url, conn_args)
 
-def show_group(base_url, id, **conn_args):
+def show_group(base_url, id, cached=True, **conn_args):
     '''
        Show a Group.
        API Doc URL : https://teampasswordmanager.com/docs/api-groups/#show_group
@@ -1383,6 +2080,7 @@ def show_group(base_url, id, **conn_args):
        Args:
        base_url    : Your Team Password Manager URL
        id          : Internal id of the group.
+       cached      : If False, the group is read from TPM and not from the response cache
        **conn_args : (Method: 1)  For HTTP Basic Authentication pass conn_args as username and password
                      (Method: 2)  For HMAC Authentication pass conn_args as private_key and public_key
 
@@ -1391,7 +2089,9 @@ def show_group(base_url, id, **conn_args):
 
     tpmconn = TpmApi(base_url, conn_args)
     log.debug('Show group %s' % id)
-    return tpmconn.get('groups/%s.json' % id)
+    if not cached:
+        return tpmconn.get('groups/%s.json' % id)
+    return tpmconn.get_cached('groups/%s.json' % id)
 
 def create_group(base_url, name, **conn_args):
     '''
@@ -1412,6 +2112,7 @@ def create_group(base_url, name, **conn_args):
     tpmconn = TpmApi(base_url, conn_args)
     log.info('Create group with %s' % data)
     new_id = tpmconn.post('groups.json', data).get('id')
+    _invalidate_directory('groups', base_url, conn_args)
     log.info('Group has been created with id %s' % new_id)
     return new_id
 
@@ -1436,6 +2137,7 @@ def update_group(base_url, id, new_name, **conn_args):
     tpmconn = TpmApi(base_url, conn_args)
     log.info('Update group %s with %s' % (id, data))
     tpmconn.put('groups/%s.json' % id, data)
+    _invalidate_directory('groups', base_url, conn_args)
 
     return True
 
@@ -1458,6 +2160,7 @@ def add_user_to_group(base_url, group_id, user_id, **conn_args):
     tpmconn = TpmApi(base_url, conn_args)
     log.info('Add User %s to Group %s' % (user_id, group_id))
     tpmconn.put('groups/%s/add_user/%s.json' % (group_id, user_id))
+    _invalidate_directory('groups', base_url, conn_args)
 
     return True
 
@@ -1480,6 +2183,7 @@ def delete_user_from_group(base_url, group_id, user_id, **conn_args):
     tpmconn = TpmApi(base_url, conn_args)
     log.info('Delete user %s from group %s' % (user_id, group_id))
     tpmconn.put('groups/%s/delete_user/%s.json' % (group_id, user_id))
+    _invalidate_directory('groups', base_url, conn_args)
 
     return True
 
@@ -1501,9 +2205,171 @@ def delete_group(base_url, id, **conn_args):
     tpmconn = TpmApi(base_url, conn_args)
     log.info('Delete group %s' % id)
     tpmconn.delete('groups/%s.json' % id)
+    _invalidate_directory('groups', base_url, conn_args)
 
     return True
 
+def secret_cache_stats():
+    '''
+       Return the hits, misses and bytes served locally by the teampass secret cache
+       for this minion process.
+
+       Password records read by show_password and show_passwords_many are kept in memory
+       for teampass.secret_cache_ttl seconds (default 60), and also encrypted on disk
+       with a key derived from the minion key if teampass.secret_cache_disk is True.
+       They are forgotten as soon as the password is changed through this module.
+
+       CLI Example:
+       .. code-block:: bash
+           salt '*' teampass.secret_cache_stats
+    '''
+    stats = dict(_secret_stats())
+    stats['entries'] = sum(len(entries) for entries in __context__.get('teampass.secrets', {}).values())
+    return stats
+
+def _read_snapshot(records_file):
+    '''
+    Return the records of a snapshot file by id, the last written record of an id wins.
+    '''
+    records = {}
+    if not os.path.exists(records_file):
+        return records
+    with gzip.open(records_file, 'rb') as fp_:
+        for id, updated_on, record in msgpack.Unpacker(fp_, raw=False):
+            if record is None:
+                records.pop(id, None)
+            else:
+                records[id] = [id, updated_on, record]
+    return records
+
+def _write_snapshot(records_file, records, mode):
+    '''
+    Write records to a snapshot file (mode 0600), as a new gzip member when appending.
+    '''
+    if mode == 'wb':
+        tmp_file = records_file + '.tmp'
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    else:
+        tmp_file = records_file
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+    with os.fdopen(os.open(tmp_file, flags, 0o600), mode) as raw:
+        with gzip.GzipFile(fileobj=raw, mode=mode) as fp_:
+            for record in records:
+                fp_.write(msgpack.packb(record, use_bin_type=True))
+    if tmp_file != records_file:
+        os.rename(tmp_file, records_file)
+
+def _strip_secrets(password):
+    '''
+    Remove the password and the data of the custom fields of type Password from a password record.
+    '''
+    password.pop('password', None)
+    for number in range(1, 11):
+        custom_field = password.get('custom_field%s' % number)
+        if isinstance(custom_field, dict) and six.text_type(custom_field.get('type', '')).lower() == 'password':
+            custom_field.pop('data', None)
+    return password
+
+def snapshot(base_url, path=None, concurrency=None, include_secrets=False, compact_ratio=0.5, **conn_args):
+    '''
+       Keep a compact local snapshot of TPM projects and passwords, updated incrementally.
+
+       Args:
+       base_url       : Your Team Password Manager URL
+       path           : Snapshot directory (default <cachedir>/teampass/snapshot)
+       concurrency    : Number of changed passwords read at the same time (default teampass.fan_out_concurrency)
+       include_secrets: If True, the password field and the custom fields of type Password are kept
+                        in the snapshot (default False). Snapshot files are created with mode 0600
+       compact_ratio  : Rewrite the snapshot when superseded records exceed this ratio of live ones (default 0.5)
+       **conn_args    : (Method: 1)  For HTTP Basic Authentication pass conn_args as username and password
+                        (Method: 2)  For HMAC Authentication pass conn_args as private_key and public_key
+
+       The snapshot directory holds passwords.mpk.gz, gzip compressed msgpack records [id, updated_on, password]
+       appended as one gzip member per run, and index.mpk, the [id, updated_on] pairs and the projects list.
+       Only the passwords whose updated_on changed since the last run are read again, concurrently.
+
+       CLI Example:
+       .. code-block:: bash
+           salt '*' teampass.snapshot https://tpm.example.com username=salt password=secret
+    '''
+    if not HAS_MSGPACK:
+        raise CommandExecutionError('teampass.snapshot needs the python msgpack library')
+
+    start = time.time()
+    if path is None:
+        path = os.path.join(__opts__['cachedir'], 'teampass', 'snapshot')
+    if not os.path.isdir(path):
+        os.makedirs(path, 0o700)
+    records_file = os.path.join(path, 'passwords.mpk.gz')
+    index_file = os.path.join(path, 'index.mpk')
+
+    index = {'updated_on': [], 'written': 0}
+    if os.path.exists(index_file) and os.path.exists(records_file):
+        with salt.utils.files.fopen(index_file, 'rb') as fp_:
+            index = msgpack.unpackb(fp_.read(), raw=False)
+
+    tpmconn = TpmApi(base_url, conn_args)
+    updated_on = dict(_project_fields(password, ('id', 'updated_on'))
+                      for password in tpmconn.iter_collection('passwords.json'))
+    previous = dict(index['updated_on'])
+    changed = [id for id in updated_on if previous.get(id, '') != updated_on[id]]
+    deleted = [id for id in previous if id not in updated_on]
+    log.info('Snapshot of %s: %s changed and %s deleted passwords', base_url, len(changed), len(deleted))
+
+    records = []
+    if changed:
+        passwords = tpmconn.get_many(['passwords/%s.json' % id for id in changed], concurrency)
+        for id, password in zip(changed, passwords):
+            if not include_secrets:
+                _strip_secrets(password)
+            records.append([id, updated_on[id], password])
+    records.extend([id, None, None] for id in deleted)
+
+    compacted = False
+    written = index['written'] + len(records)
+    if written - len(updated_on) > len(updated_on) * float(compact_ratio):
+        live = _read_snapshot(records_file)
+        for record in records:
+            if record[2] is None:
+                live.pop(record[0], None)
+            else:
+                live[record[0]] = record
+        _write_snapshot(records_file, list(live.values()), 'wb')
+        written = len(live)
+        compacted = True
+    elif records:
+        _write_snapshot(records_file, records, 'ab')
+
+    index = {'updated_on': sorted(updated_on.items()),
+             'written': written,
+             'projects': tpmconn.collection('projects.json'),
+             'time': time.time()}
+    tmp_file = index_file + '.tmp'
+    with os.fdopen(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as fp_:
+        fp_.write(msgpack.packb(index, use_bin_type=True))
+    os.rename(tmp_file, index_file)
+
+    return {'path': path,
+            'passwords': len(updated_on),
+            'projects': len(index['projects']),
+            'changed': len(changed),
+            'deleted': len(deleted),
+            'compacted': compacted,
+            'elapsed': round(time.time() - start, 3)}
+
+def cache_stats():
+    '''
+       Return the hits and misses of the teampass response cache for this minion process.
+
+       CLI Example:
+       .. code-block:: bash
+           salt '*' teampass.cache_stats
+    '''
+    stats = dict(__context__.get('teampass.cache_stats', {'hits': 0, 'misses': 0}))
+    total = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = round(float(stats['hits']) / total, 3) if total else 0.0
+    return stats
+
 def generate_password(base_url, **conn_args):
     '''
        Generate a new random password.
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+'''
+Written by: pankaj ghadge
+Team Password Manager External Pillar
+
+Serve Team Password Manager passwords as pillar data. Passwords are synced on the master
+into an index, which is refreshed incrementally: the passwords list is read every
+refresh_interval seconds and only the passwords whose updated_on changed are read again.
+Minions get their pillar from the index, so they never call TPM themselves.
+
+The index is kept in <cachedir>/teampass/pillar (readable by the master user only), as the
+pillar module is loaded again for every pillar compile.
+
+The teampass execution module must be synced to the master (salt-run saltutil.sync_modules).
+
+Master config:
+    ext_pillar:
+      - teampass:
+          base_url: https://tpm.example.com
+          username: salt
+          password: secret          # or private_key / public_key for HMAC authentication
+          refresh_interval: 300     # seconds between two syncs (default 300)
+          concurrency: 10           # passwords read at the same time (default teampass.fan_out_concurrency)
+          pillar_key: teampass      # pillar key of the passwords (default teampass)
+          minions:                  # projects served to the minions matching a glob
+            'web*':
+              - Web servers
+            '*':
+              - Common
+
+Pillar data:
+    teampass:
+      Web servers:
+        db-root:
+          username: root
+          password: secret
+          ...
+'''
+
+# Import python libs
+from __future__ import absolute_import, print_function, unicode_literals
+import fnmatch
+import hashlib
+import logging
+import os
+import time
+
+# Import salt libs
+import salt.utils.files
+from salt.ext import six
+from salt.exceptions import CommandExecutionError
+
+try:
+    import msgpack
+    HAS_MSGPACK = True
+except ImportError:
+    HAS_MSGPACK = False
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = 'teampass'
+
+# Fields of a password record served in pillar
+_PILLAR_FIELDS = ('name', 'username', 'password', 'email', 'access_info', 'tags', 'notes', 'expiry_date')
+
+# Synced indexes by (base_url, credentials digest), read from and written to the cachedir
+_INDEXES = {}
+
+def __virtual__():
+    '''
+    Load only if the teampass execution module is available
+    '''
+    if 'teampass.list_passwords' in __salt__:
+        return __virtualname__
+    return (False, 'teampass ext_pillar cannot be loaded: teampass execution module not available.')
+
+def _index_key(base_url, conn_args):
+    fingerprint = hashlib.sha256()
+    for key in ('username', 'password', 'public_key', 'private_key'):
+        fingerprint.update(six.text_type(conn_args.get(key, '')).encode('utf-8'))
+        fingerprint.update(b'\0')
+    return (base_url, fingerprint.hexdigest())
+
+def _index_file(key):
+    return os.path.join(__opts__['cachedir'], 'teampass', 'pillar',
+                        hashlib.sha256('|'.join(key).encode('utf-8')).hexdigest() + '.mpk')
+
+def _load_index(key):
+    '''
+    Return the index saved by the last sync, or an empty index.
+    '''
+    index = {'synced': 0, 'passwords': {}, 'updated_on': {}}
+    index_file = _index_file(key)
+    if not HAS_MSGPACK or not os.path.exists(index_file):
+        return index
+    try:
+        with salt.utils.files.fopen(index_file, 'rb') as fp_:
+            saved = msgpack.unpackb(fp_.read(), raw=False)
+        for id, updated_on, password in saved['passwords']:
+            index['passwords'][id] = password
+            index['updated_on'][id] = updated_on
+        index['synced'] = saved['synced']
+    except Exception as e:  # pylint: disable=broad-except
+        log.warning('Ignore unreadable teampass pillar index %s: %s', index_file, e)
+        index = {'synced': 0, 'passwords': {}, 'updated_on': {}}
+    return index
+
+def _save_index(key, index):
+    '''
+    Write the index to the cachedir, mode 0600 as it holds the passwords.
+    '''
+    if not HAS_MSGPACK:
+        return
+    index_file = _index_file(key)
+    saved = {'synced': index['synced'],
+             'passwords': [[id, index['updated_on'].get(id), password]
+                           for id, password in six.iteritems(index['passwords'])]}
+    try:
+        index_dir = os.path.dirname(index_file)
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir, 0o700)
+        # Pillar is compiled by several master processes, each writes its own tmp file
+        tmp_file = '%s.%s.tmp' % (index_file, os.getpid())
+        with os.fdopen(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as fp_:
+            fp_.write(msgpack.packb(saved, use_bin_type=True))
+        os.rename(tmp_file, index_file)
+    except (IOError, OSError) as e:
+        log.warning('Can not write teampass pillar index %s: %s', index_file, e)
+
+def _pillar_record(record):
+    '''
+    Return the pillar view of a password record, custom fields by label.
+    '''
+    data = dict((field, record.get(field)) for field in _PILLAR_FIELDS if field in record)
+    for number in range(1, 11):
+        custom_field = record.get('custom_field%s' % number)
+        if custom_field and custom_field.get('label'):
+            data[custom_field['label']] = custom_field.get('data')
+    return data
+
+def _sync(index, base_url, concurrency, conn_args):
+    '''
+    Bring the index up to date: list the passwords and read only the new or changed ones.
+    '''
+    listed = __salt__['teampass.list_passwords'](base_url, **conn_args)
+    updated_on = dict((password['id'], password.get('updated_on')) for password in listed)
+
+    changed = [id for id in updated_on if id not in index['passwords'] or index['updated_on'].get(id) != updated_on[id]]
+    removed = [id for id in index['passwords'] if id not in updated_on]
+    log.debug('teampass pillar sync: %s changed, %s removed, %s unchanged',
+              len(changed), len(removed), len(updated_on) - len(changed))
+
+    if changed:
+        records = __salt__['teampass.show_passwords_many'](base_url, changed, concurrency, **conn_args)
+        for id in changed:
+            index['passwords'][id] = {'project': records[id]['project']['name'],
+                                      'name': records[id]['name'],
+                                      'data': _pillar_record(records[id])}
+            index['updated_on'][id] = updated_on[id]
+    for id in removed:
+        index['passwords'].pop(id, None)
+        index['updated_on'].pop(id, None)
+    index['synced'] = time.time()
+
+def ext_pillar(minion_id,
+               pillar,  # pylint: disable=W0613
+               base_url,
+               minions=None,
+               refresh_interval=300,
+               concurrency=None,
+               pillar_key='teampass',
+               **conn_args):
+    '''
+    Return the passwords of the projects assigned to minion_id
+    '''
+    projects = set()
+    for target, target_projects in six.iteritems(minions or {}):
+        if fnmatch.fnmatch(minion_id, target):
+            projects.update(target_projects)
+    if not projects:
+        return {}
+
+    key = _index_key(base_url, conn_args)
+    index = _INDEXES.get(key)
+    if index is None or time.time() - index['synced'] >= float(refresh_interval):
+        # Another master process may have synced it since
+        index = _INDEXES[key] = _load_index(key)
+    if time.time() - index['synced'] >= float(refresh_interval):
+        try:
+            _sync(index, base_url, concurrency, conn_args)
+            _save_index(key, index)
+        except CommandExecutionError as e:
+            # Serve the last synced index rather than no pillar at all
+            log.error('teampass pillar sync failed: %s', e)
+
+    data = {}
+    for password in six.itervalues(index['passwords']):
+        if password['project'] in projects:
+            data.setdefault(password['project'], {})[password['name']] = password['data']
+    return {pillar_key: data}
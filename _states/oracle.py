@@ -257,6 +257,9 @@ def run_query(name,
         output=None,
         overwrite=True,
         check_db_exists=False,
+        output_format=None,
+        arraysize=None,
+        params=None,
         **connection_args):
 
     '''
@@ -270,6 +273,14 @@ def run_query(name,
     output
         the file to store results
         OR None: output to the result comment (default)
+    output_format
+        csv or jsonl: rows are streamed into output as they are fetched and
+        only a summary (rows returned, bytes, query time) is kept in the comment
+        OR None: rows are written as col:val lines (default)
+    arraysize
+        Number of rows fetched per round trip, used with output_format
+    params
+        Bind values of the query, dict for named (:name) or list for positional (:1) binds
     check_db_exists:
         The state run will check that the specified database exists (default=False)
         before running any queries
@@ -313,7 +324,24 @@ def run_query(name,
         ret['comment'] = 'Query would execute, not storing result'
         return ret
 
-    query_result = __salt__['devops_oracle.run_query'](sid, query, connection_mode, **connection_args)
+    if output is not None and output_format is not None:
+        query_result = __salt__['devops_oracle.run_query'](sid, query, connection_mode,
+                                                           output=output,
+                                                           output_format=output_format,
+                                                           arraysize=arraysize,
+                                                           params=params,
+                                                           **connection_args)
+        err = _get_oracle_error()
+        if err is not None:
+            ret['comment'] = err
+            ret['result'] = False
+            return ret
+
+        ret['comment'] = six.text_type(query_result)
+        ret['changes']['query'] = "Executed. Output into " + output
+        return ret
+
+    query_result = __salt__['devops_oracle.run_query'](sid, query, connection_mode, arraysize=arraysize, params=params, **connection_args)
     mapped_results = []
 
     err = _get_oracle_error()
@@ -350,3 +378,52 @@ def run_query(name,
         ret['changes']['query'] = "Executed"
 
     return ret
+
+def instances_open(name,
+        sids,
+        timeout=10,
+        concurrency=None,
+        **connection_args):
+
+    '''
+    Check that all the specified databases (sids) are OPEN, they are queried concurrently
+    name
+        Used only as an ID
+    sids
+        List of database names to check, or a comma separated string (DB1,DB2)
+    timeout
+        Seconds allowed per database
+    concurrency
+        Number of databases queried at the same time
+    '''
+
+    ret = {'name': name,
+           'changes': {},
+           'result': True,
+           'comment': ''}
+
+    if isinstance(sids, six.string_types):
+       sids = [sid.strip() for sid in sids.split(',') if sid.strip()]
+
+    if __opts__['test']:
+       ret['result'] = None
+       ret['comment'] = 'Will check that databases {} are open'.format(', '.join(sids))
+       return ret
+
+    status = __salt__['devops_oracle.status_many'](sids, timeout, concurrency, **connection_args)
+
+    not_open = {}
+    for sid in sids:
+        sid_status = status.get(sid, {})
+        if sid_status.get('status') != 'OPEN':
+           not_open[sid] = sid_status.get('error') or sid_status.get('status')
+
+    ret['out'] = status
+    if not_open:
+       ret['result'] = False
+       ret['comment'] = 'Databases not open: {}'.format(
+           ', '.join('{} ({})'.format(sid, state) for sid, state in sorted(not_open.items())))
+       return ret
+
+    ret['comment'] = 'All databases are open: {}'.format(', '.join(sids))
+    return ret
@@ -9,11 +9,17 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 # Import Salt libs
+import salt.utils.files
 import salt.utils.json
+from salt.exceptions import CommandExecutionError
 
 # Import 3rd-party libs
 from salt.ext import six
+import hashlib
 import logging
+import os
+import re
+from multiprocessing.pool import ThreadPool
 log = logging.getLogger(__name__)
 
 
@@ -63,6 +69,12 @@ def _load_result(ret, error, value =""):
 
     return ret
 
+# Valid permission ids of a project and of a password
+_TPM_PERMISSIONS = {
+    "project": frozenset([-1, 0, 10, 20, 30, 40, 50, 60, 99]),
+    "password": frozenset([0, 10, 20, 30]),
+}
+
 def _check_tpm_permission(permission, item):
     """
       Project: permission_id can be:
@@ -80,44 +92,137 @@ def _check_tpm_permission(permission, item):
       permission_id can be: 0=no acces, 10=read, 20=edit data, 30=manage
 
     """
-    tpm_permissions = []
-    if item == 'project':
-       tpm_permissions = [-1, 0, 10, 20, 30, 40, 50, 60, 99]
-    elif item == 'password':
-       tpm_permissions = [0, 10, 20, 30]
+    tpm_permissions = _TPM_PERMISSIONS.get(item, frozenset())
 
     if isinstance(permission,list):
-       permission = list(set(permission))
-       if(set(permission).issubset(set(tpm_permissions))):
-          return True
-    elif isinstance(permission,int) and (permission in tpm_permissions):
-          return True
+       return set(permission) <= tpm_permissions
+    elif isinstance(permission,int):
+       return permission in tpm_permissions
     return False
 
-def _get_users_permissions_ids(users_permissions, base_url, field = "name", **conn_args):
-    users = __salt__["teampass.list_users"](base_url, **conn_args)
-    users_match = list(filter(lambda user: user["name"] in users_permissions.keys(), users))
-
-    users_permissions_list = []
-
-    for i, user in enumerate(users_match):
-        users_permissions_list.append([users_match[i]["id"], users_permissions[users_match[i][field]]])
-
-    #users_permissions_dict = dict((users_match[key], value) for (key, value) in users_permissions.items())
+def _permissions_ids(kind, permissions, base_url, field, conn_args):
+    """
+    Translate {name: permission} to [[id, permission]] with the users or groups
+    indexes of the teampass module, which are cached and dropped on change there.
+    """
+    get_by = __salt__["teampass.get_" + kind[:-1] + "_by"]
+    ids = {}
+    for name in permissions:
+        found = get_by(field, name, base_url, **conn_args)
+        if len(found) == 1:
+            ids[name] = found[0]["id"]
+        elif found:
+            log.warning("Ignore permissions of %s %s, the name is not unique", kind, name)
+    unknown = set(permissions) - set(ids)
+    if unknown:
+        log.warning("Ignore permissions of unknown %s: %s", kind, ", ".join(sorted(unknown)))
+    return [[ids[name], permission] for name, permission in six.iteritems(permissions) if name in ids]
 
-    return users_permissions_list
+def _get_users_permissions_ids(users_permissions, base_url, field = "name", **conn_args):
+    return _permissions_ids("users", users_permissions, base_url, field, conn_args)
 
 
 def _get_groups_permissions_ids(groups_permissions, base_url, field = "name", **conn_args):
-    groups = __salt__["teampass.list_groups"](base_url, **conn_args)
-    groups_match = list(filter(lambda group: group["name"] in groups_permissions.keys(), groups))
+    return _permissions_ids("groups", groups_permissions, base_url, field, conn_args)
 
-    groups_permissions_list = []
+def _security_file(security_dir, base_url, kind, item_id):
+    """
+    Return the file holding the digest of the security last set on a project or password.
+    """
+    key = hashlib.sha256(("%s|%s|%s" % (base_url, kind, item_id)).encode("utf-8")).hexdigest()
+    return os.path.join(security_dir, key)
 
-    for i, group in enumerate(groups_match):
-        groups_permissions_list.append([groups_match[i]["id"], groups_permissions[groups_match[i][field]]])
+def _security_digest(data):
+    return hashlib.sha256(salt.utils.json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
 
-    return groups_permissions_list
+def _security_is_current(security_file, data):
+    """
+    Return True if data is the security this minion last set on the item.
+    TPM only exposes the effective access (groups and inheritance included), not the
+    explicit ACL, so the security is compared to the last one sent instead: a change
+    made in TPM itself is not seen until the declared security changes or the digest
+    files in <cachedir>/teampass/security are removed.
+    """
+    try:
+        with salt.utils.files.fopen(security_file, "r") as fp_:
+            return fp_.read().strip() == _security_digest(data)
+    except (IOError, OSError):
+        return False
+
+def _apply_security(update_security, security_file, item_id, data, base_url, conn_args):
+    """
+    Set the security of a project or password unless it is the one last set,
+    return True if it was sent. The PUT replaces the ACL.
+    The teampass function and the digest file are passed in, so this can run in a worker thread.
+    """
+    if _security_is_current(security_file, data):
+       return False
+    update_security(base_url, item_id, data, **conn_args)
+    try:
+        if not os.path.isdir(os.path.dirname(security_file)):
+           os.makedirs(os.path.dirname(security_file), 0o700)
+        with salt.utils.files.fopen(security_file, "w") as fp_:
+            fp_.write(_security_digest(data))
+    except (IOError, OSError) as err:
+        log.warning("Can not write security digest %s: %s", security_file, err)
+    return True
+
+def _resolver(base_url, conn_args):
+    """
+    Return the name index of TPM projects and passwords for this state run.
+    It is kept in __context__ and shared by every teampass state, so projects
+    are listed once per run and the passwords of a project once per project.
+    """
+    resolvers = __context__.setdefault("teampass.resolver", {})
+    # Credentials are never kept in clear text as a cache key
+    fingerprint = hashlib.sha256(salt.utils.json.dumps(conn_args, sort_keys=True, default=six.text_type).encode("utf-8"))
+    key = (base_url, fingerprint.hexdigest())
+    if key not in resolvers:
+        resolvers[key] = {"projects": None, "passwords": {}}
+    return resolvers[key]
+
+def _resolve_projects(name, base_url, **conn_args):
+    """
+    Return the list of projects (active or archived) named name.
+    """
+    index = _resolver(base_url, conn_args)
+    if index["projects"] is None:
+        projects_by_name = {}
+        seen = set()
+        projects = __salt__["teampass.list_projects"](base_url, **conn_args) + \
+                   __salt__["teampass.list_projects_archived"](base_url, **conn_args)
+        for project in projects:
+            if project["id"] in seen:
+                continue
+            seen.add(project["id"])
+            projects_by_name.setdefault(project["name"], []).append(project)
+        index["projects"] = projects_by_name
+    return list(index["projects"].get(name, []))
+
+def _resolve_passwords(name, project, base_url, **conn_args):
+    """
+    Return the list of passwords named name in the project named project.
+    """
+    index = _resolver(base_url, conn_args)
+    if project not in index["passwords"]:
+        passwords_by_name = {}
+        for current_project in _resolve_projects(project, base_url, **conn_args):
+            passwords = __salt__["teampass.list_passwords_of_project"](base_url, current_project["id"], **conn_args)
+            for password in passwords:
+                passwords_by_name.setdefault(password["name"], []).append(password)
+        index["passwords"][project] = passwords_by_name
+    return list(index["passwords"][project].get(name, []))
+
+def _invalidate_resolver(base_url, conn_args, project=None):
+    """
+    Forget the projects index, or only the passwords of project, after a change in TPM.
+    """
+    index = _resolver(base_url, conn_args)
+    if project is None:
+        index["projects"] = None
+        index["passwords"] = {}
+    else:
+        index["passwords"].pop(project, None)
 
 def create_project(name, base_url, data, **conn_args):
 
@@ -145,10 +250,10 @@ def create_project(name, base_url, data, **conn_args):
        return _test_output( ret, "create", "project" )
 
     # is this project currently configured?
-    search = __salt__["teampass.list_projects_search"](base_url, name, exact_match = True, **conn_args)
+    search = _resolve_projects(name, base_url, **conn_args)
 
     if 'parent' in data:
-        search_parent_project = __salt__["teampass.list_projects_search"](base_url, data['parent'], exact_match = True, **conn_args)
+        search_parent_project = _resolve_projects(data['parent'], base_url, **conn_args)
         if len(search_parent_project) == 1:
            project             = search_parent_project[0]
            data['parent_id']   = project['id']
@@ -160,6 +265,7 @@ def create_project(name, base_url, data, **conn_args):
 
     if not search:
        new_id = __salt__["teampass.create_project"](name, base_url, data, **conn_args)
+       _invalidate_resolver(base_url, conn_args)
        if new_id:
           ret["result"] = True
           ret["changes"]["old"] = {}
@@ -199,7 +305,7 @@ def update_project(name, base_url, data, **conn_args):
        return _test_output( ret, "update", "project" )
 
     # is this project currently configured?
-    search = __salt__["teampass.list_projects_search"](base_url, name, exact_match = True, **conn_args)
+    search = _resolve_projects(name, base_url, **conn_args)
 
     if len(search) == 1:
        project      = search[0]
@@ -207,6 +313,7 @@ def update_project(name, base_url, data, **conn_args):
        project_name = project['name']
 
        flag = __salt__["teampass.update_project"](project_name, base_url, project_id, data, **conn_args)
+       _invalidate_resolver(base_url, conn_args)
        if flag:
           ret["result"] = True
           ret["changes"]["old"] = {}
@@ -245,10 +352,10 @@ def change_parent_of_project(name, base_url, new_parent, **conn_args):
 
 
     # is this project currently configured?
-    search = __salt__["teampass.list_projects_search"](base_url, name, exact_match = True, **conn_args)
+    search = _resolve_projects(name, base_url, **conn_args)
 
     # is this project currently configured?
-    new_parent = __salt__["teampass.list_projects_search"](base_url, new_parent, exact_match = True, **conn_args)
+    new_parent = _resolve_projects(new_parent, base_url, **conn_args)
 
     # This project already has the requested parent
 
@@ -256,7 +363,7 @@ def change_parent_of_project(name, base_url, new_parent, **conn_args):
          project      = search[0]
          project_id   = project['id']
 
-         current_project = __salt__["teampass.show_project"](base_url, project_id, **conn_args)
+         current_project = __salt__["teampass.show_project"](base_url, project_id, cached=False, **conn_args)
          parent_id       = current_project['parent_id']
 
          new_project      = new_parent[0]
@@ -284,14 +391,14 @@ def update_security_of_project(name, base_url, data, **conn_args):
     if "users_permissions" in data:
        users_permissions = _get_users_permissions_ids(data["users_permissions"], base_url, **conn_args)
        if not _check_tpm_permission(list(data["users_permissions"].values()), 'project'):
-          ret = _load_result(ret, 'Permissions')
+          ret = _load_result(ret, 'Permission')
           return ret
        data["users_permissions"] = users_permissions
 
     if "groups_permissions" in data:
        groups_permissions = _get_groups_permissions_ids(data["groups_permissions"], base_url, **conn_args)
        if not _check_tpm_permission(list(data["groups_permissions"].values()), 'project'):
-          ret = _load_result(ret, 'Permissions')
+          ret = _load_result(ret, 'Permission')
           return ret
        data["groups_permissions"] = groups_permissions
 
@@ -307,19 +414,24 @@ def update_security_of_project(name, base_url, data, **conn_args):
        return _test_output( ret, "update", "update security of project" )
 
     # is this project currently configured?
-    search = __salt__["teampass.list_projects_search"](base_url, name, exact_match = True, **conn_args)
+    search = _resolve_projects(name, base_url, **conn_args)
 
     if len(search) == 1:
        project      = search[0]
        project_id   = project['id']
        project_name = project['name']
 
-       data = __salt__["teampass.update_security_of_project"](base_url, project_id, data, **conn_args)
+       security_file = _security_file(os.path.join(__opts__["cachedir"], "teampass", "security"),
+                                      base_url, "project", project_id)
+       changed = _apply_security(__salt__["teampass.update_security_of_project"],
+                                 security_file, project_id, data, base_url, conn_args)
 
-       if data:
-          ret["result"] = True
+       ret["result"] = True
+       if changed:
           ret["changes"]["new"] = "Security of project updated"
           ret["comment"] = "Security of project updated successfully"
+       else:
+          ret["comment"] = "Security of project is already in the correct state"
 
     # else something else was returned
     else:
@@ -334,14 +446,14 @@ def archive_project(name, base_url, **conn_args):
        return _test_output( ret, "archive", "project" )
 
     # is this project currently configured?
-    search = __salt__["teampass.list_projects_search"](base_url, name, exact_match = True, **conn_args)
+    search = _resolve_projects(name, base_url, **conn_args)
 
     if len(search) == 1:
        project      = search[0]
        project_id   = project['id']
        project_name = project['name']
 
-       current_project = __salt__["teampass.show_project"](base_url, project_id, **conn_args)
+       current_project = __salt__["teampass.show_project"](base_url, project_id, cached=False, **conn_args)
        is_archived     = current_project['archived']
 
        if not is_archived:
@@ -370,14 +482,14 @@ def unarchive_project(name, base_url, **conn_args):
        return _test_output( ret, "unarchive", "project" )
 
     # is this project currently configured?
-    search = __salt__["teampass.list_projects_search"](base_url, name, exact_match = True, **conn_args)
+    search = _resolve_projects(name, base_url, **conn_args)
 
     if len(search) == 1:
        project      = search[0]
        project_id   = project['id']
        project_name = project['name']
 
-       current_project = __salt__["teampass.show_project"](base_url, project_id, **conn_args)
+       current_project = __salt__["teampass.show_project"](base_url, project_id, cached=False, **conn_args)
        is_archived     = current_project['archived']
 
        if is_archived:
@@ -409,18 +521,19 @@ def delete_project(name, base_url, **conn_args):
        return _test_output( ret, "delete", "project" )
 
     # is this project currently configured?
-    search = __salt__["teampass.list_projects_search"](base_url, name, exact_match = True, **conn_args)
+    search = _resolve_projects(name, base_url, **conn_args)
 
     if len(search) == 1:
        project      = search[0]
        project_id   = project['id']
        project_name = project['name']
 
-       current_project = __salt__["teampass.show_project"](base_url, project_id, **conn_args)
+       current_project = __salt__["teampass.show_project"](base_url, project_id, cached=False, **conn_args)
        is_leaf         = current_project['is_leaf']
 
        if is_leaf:
           flag = __salt__["teampass.delete_project"](base_url, project_id, **conn_args)
+          _invalidate_resolver(base_url, conn_args)
 
           if flag:
              ret["result"] = True
@@ -444,7 +557,7 @@ def set_favorite_project(name, base_url, **conn_args):
        return _test_output( ret, "unarchive", "project" )
 
     # is this project currently configured?
-    search = __salt__["teampass.list_projects_search"](base_url, name, exact_match = True, **conn_args)
+    search = _resolve_projects(name, base_url, **conn_args)
 
     if len(search) == 1:
        project      = search[0]
@@ -481,7 +594,7 @@ def unset_favorite_project(name, base_url, **conn_args):
        return _test_output( ret, "unarchive", "project" )
 
     # is this project currently configured?
-    search = __salt__["teampass.list_projects_search"](base_url, name, exact_match = True, **conn_args)
+    search = _resolve_projects(name, base_url, **conn_args)
 
     if len(search) == 1:
        project      = search[0]
@@ -514,7 +627,7 @@ def unset_favorite_project(name, base_url, **conn_args):
 def create_password(name, base_url, project, data, **conn_args):
     ret = {"name": name, "changes": {}, "result": False, "comment": ""}
 
-    project_search = __salt__["teampass.list_projects_search"](base_url, project, exact_match = True, **conn_args)
+    project_search = _resolve_projects(project, base_url, **conn_args)
 
     if len(project_search) == 0:
        ret["comment"] = "Project with this name does not exists in TPM"
@@ -526,11 +639,11 @@ def create_password(name, base_url, project, data, **conn_args):
        return _test_output( ret, "create", "password" )
 
     # is this project currently configured?
-    search = __salt__["teampass.list_passwords_search"](base_url, name, exact_match = True, **conn_args)
-    is_duplicate = list(filter(lambda password: project == password['project']['name'] and name == password['name'], search))
+    is_duplicate = _resolve_passwords(name, project, base_url, **conn_args)
 
     if len(is_duplicate) == 0:
        new_id = __salt__["teampass.create_password"](name, base_url, data, **conn_args)
+       _invalidate_resolver(base_url, conn_args, project)
        if new_id:
           ret["result"] = True
           ret["changes"]["old"] = {}
@@ -547,7 +660,7 @@ def create_password(name, base_url, project, data, **conn_args):
 def update_password(name, base_url, project, data, **conn_args):
     ret = {"name": name, "changes": {}, "result": False, "comment": ""}
 
-    project_search = __salt__["teampass.list_projects_search"](base_url, project, exact_match = True, **conn_args)
+    project_search = _resolve_projects(project, base_url, **conn_args)
 
     if len(project_search) == 0:
        ret["comment"] = "Project with this name does not exists in TPM"
@@ -557,8 +670,7 @@ def update_password(name, base_url, project, data, **conn_args):
        return _test_output( ret, "create", "project" )
 
     # is this project currently configured?
-    search = __salt__["teampass.list_passwords_search"](base_url, name, exact_match = True, **conn_args)
-    is_duplicate = list(filter(lambda password: project == password['project']['name'] and name == password['name'], search))
+    is_duplicate = _resolve_passwords(name, project, base_url, **conn_args)
 
     if len(is_duplicate) == 1:
        password      = is_duplicate[0]
@@ -566,6 +678,7 @@ def update_password(name, base_url, project, data, **conn_args):
        password_name = password['name']
 
        flag = __salt__["teampass.update_password"](password_name, base_url, password_id, data, **conn_args)
+       _invalidate_resolver(base_url, conn_args, project)
        if flag:
           ret["result"] = True
           ret["changes"]["old"] = {}
@@ -581,7 +694,7 @@ def update_password(name, base_url, project, data, **conn_args):
 def update_security_of_password(name, base_url, project, data, **conn_args):
     ret = {"name": name, "changes": {}, "result": False, "comment": ""}
 
-    project_search = __salt__["teampass.list_projects_search"](base_url, project, exact_match = True, **conn_args)
+    project_search = _resolve_projects(project, base_url, **conn_args)
 
     if len(project_search) == 0:
        ret["comment"] = "Project with this name does not exists in TPM"
@@ -590,14 +703,14 @@ def update_security_of_password(name, base_url, project, data, **conn_args):
     if "users_permissions" in data:
        users_permissions = _get_users_permissions_ids(data["users_permissions"], base_url, **conn_args)
        if not _check_tpm_permission(list(data["users_permissions"].values()), 'password'):
-          ret = _load_result(ret, 'Permissions')
+          ret = _load_result(ret, 'Permission')
           return ret
        data["users_permissions"] = users_permissions
 
     if "groups_permissions" in data:
        groups_permissions = _get_groups_permissions_ids(data["groups_permissions"], base_url, **conn_args)
        if not _check_tpm_permission(list(data["groups_permissions"].values()), 'password'):
-          ret = _load_result(ret, 'Permissions')
+          ret = _load_result(ret, 'Permission')
           return ret
        data["groups_permissions"] = groups_permissions
 
@@ -613,20 +726,24 @@ def update_security_of_password(name, base_url, project, data, **conn_args):
        return _test_output( ret, "update", "update security of password")
 
     # is this project and password currently configured?
-    search = __salt__["teampass.list_passwords_search"](base_url, name, exact_match = True, **conn_args)
-    is_duplicate = list(filter(lambda password: project == password['project']['name'] and name == password['name'], search))
+    is_duplicate = _resolve_passwords(name, project, base_url, **conn_args)
 
     if len(is_duplicate) == 1:
        password      = is_duplicate[0]
        password_id   = password['id']
        password_name = password['name']
 
-       flag = __salt__["teampass.update_security_of_password"](base_url, password_id, data, **conn_args)
+       security_file = _security_file(os.path.join(__opts__["cachedir"], "teampass", "security"),
+                                      base_url, "password", password_id)
+       changed = _apply_security(__salt__["teampass.update_security_of_password"],
+                                 security_file, password_id, data, base_url, conn_args)
 
-       if flag:
-          ret["result"] = True
+       ret["result"] = True
+       if changed:
           ret["changes"]["new"] = "Security of password updateed"
           ret["comment"] = "Security of password updateed successfully"
+       else:
+          ret["comment"] = "Security of password is already in the correct state"
 
     # else something else was returned
     else:
@@ -637,7 +754,7 @@ def update_security_of_password(name, base_url, project, data, **conn_args):
 def update_custom_fields_of_password(name, base_url, project, data, **conn_args):
     ret = {"name": name, "changes": {}, "result": False, "comment": ""}
 
-    project_search = __salt__["teampass.list_projects_search"](base_url, project, exact_match = True, **conn_args)
+    project_search = _resolve_projects(project, base_url, **conn_args)
 
     if len(project_search) == 0:
        ret["comment"] = "Project with this name does not exists in TPM"
@@ -647,8 +764,7 @@ def update_custom_fields_of_password(name, base_url, project, data, **conn_args)
        return _test_output( ret, "update", "project" )
 
     # is this project currently configured?
-    search = __salt__["teampass.list_passwords_search"](base_url, name, exact_match = True, **conn_args)
-    is_duplicate = list(filter(lambda password: project == password['project']['name'] and name == password['name'], search))
+    is_duplicate = _resolve_passwords(name, project, base_url, **conn_args)
 
     if len(is_duplicate) == 1:
        password      = is_duplicate[0]
@@ -675,8 +791,7 @@ def delete_password(name, project, base_url, **conn_args):
        return _test_output( ret, "delete", "project" )
 
     # is this project currently configured?
-    search = __salt__["teampass.list_passwords_search"](base_url, name, exact_match = True, **conn_args)
-    is_duplicate = list(filter(lambda password: project == password['project']['name'] and name == password['name'], search))
+    is_duplicate = _resolve_passwords(name, project, base_url, **conn_args)
 
     if len(is_duplicate) == 1:
        password      = is_duplicate[0]
@@ -684,6 +799,7 @@ def delete_password(name, project, base_url, **conn_args):
        password_name = password['name']
 
        flag = __salt__["teampass.delete_password"](base_url, password_id, **conn_args)
+       _invalidate_resolver(base_url, conn_args, project)
 
        if flag:
           ret["result"] = True
@@ -704,8 +820,7 @@ def lock_password(name, project, base_url, **conn_args):
        return _test_output( ret, "delete", "project" )
 
     # is this project currently configured?
-    search = __salt__["teampass.list_passwords_search"](base_url, name, exact_match = True, **conn_args)
-    is_duplicate = list(filter(lambda password: project == password['project']['name'] and name == password['name'], search))
+    is_duplicate = _resolve_passwords(name, project, base_url, **conn_args)
 
     if len(is_duplicate) == 1:
        password      = is_duplicate[0]
@@ -739,8 +854,7 @@ def unlock_password(name, project, base_url, reason, **conn_args):
        return _test_output( ret, "delete", "project" )
 
     # is this project currently configured?
-    search = __salt__["teampass.list_passwords_search"](base_url, name, exact_match = True, **conn_args)
-    is_duplicate = list(filter(lambda password: project == password['project']['name'] and name == password['name'], search))
+    is_duplicate = _resolve_passwords(name, project, base_url, **conn_args)
 
     if len(is_duplicate) == 1:
        password      = is_duplicate[0]
@@ -774,7 +888,7 @@ def create_mypassword(name, base_url, data, **conn_args):
        return _test_output( ret, "create", "mypassword" )
 
     # is this mypassword currently configured?
-    search = __salt__["teampass.list_mypasswords_search"](base_url, name, exact_match = True, **conn_args)
+    search = __salt__["teampass.list_mypasswords_search"](base_url, name, exact_match = True, limit = 1, **conn_args)
 
     if len(search)==0:
        new_id = __salt__["teampass.create_mypassword"](base_url, name, data, **conn_args)
@@ -799,7 +913,7 @@ def update_mypassword(name, base_url, data, **conn_args):
        return _test_output( ret, "create", "project" )
 
     # is this mypassword currently configured?
-    search = __salt__["teampass.list_mypasswords_search"](base_url, name, exact_match = True, **conn_args)
+    search = __salt__["teampass.list_mypasswords_search"](base_url, name, exact_match = True, limit = 2, **conn_args)
 
     if len(search) == 1:
        password      = search[0]
@@ -826,7 +940,7 @@ def delete_mypassword(name, base_url, **conn_args):
        return _test_output( ret, "delete", "MyPassword" )
 
     # is this mypassword currently configured?
-    search = __salt__["teampass.list_mypasswords_search"](base_url, name, exact_match = True, **conn_args)
+    search = __salt__["teampass.list_mypasswords_search"](base_url, name, exact_match = True, limit = 2, **conn_args)
 
     if len(search) == 1:
        password      = search[0]
@@ -854,11 +968,10 @@ def set_favorite_password(name, project, base_url, **conn_args):
        return _test_output( ret, "unset", "favorite password" )
 
     # is this password and project currently configured?
-    search = __salt__["teampass.list_passwords_search"](base_url, name, exact_match = True, **conn_args)
-    is_duplicate = list(filter(lambda password: project == password['project']['name'] and name == password['name'], search))
+    is_duplicate = _resolve_passwords(name, project, base_url, **conn_args)
 
     if len(is_duplicate) == 1:
-       password      = search[0]
+       password      = is_duplicate[0]
        password_id   = password['id']
        password_name = password['name']
 
@@ -890,11 +1003,10 @@ def unset_favorite_password(name, project, base_url, **conn_args):
        return _test_output( ret, "unset", "favorite password" )
 
     # is this password and project currently configured?
-    search = __salt__["teampass.list_passwords_search"](base_url, name, exact_match = True, **conn_args)
-    is_duplicate = list(filter(lambda password: project == password['project']['name'] and name == password['name'], search))
+    is_duplicate = _resolve_passwords(name, project, base_url, **conn_args)
 
     if len(is_duplicate) == 1:
-       password      = search[0]
+       password      = is_duplicate[0]
        password_id   = password['id']
        password_name = password['name']
 
@@ -918,6 +1030,198 @@ def unset_favorite_password(name, project, base_url, **conn_args):
 
     return ret
 
+def _password_diff(data, current):
+    """
+    Return the fields of data whose value differs from the current TPM password record.
+    custom_dataN, custom_labelN and custom_typeN are compared with custom_fieldN.
+    """
+    def _normalize(value):
+        if value is None:
+            return ""
+        if isinstance(value, list):
+            return ",".join(six.text_type(item) for item in value)
+        return six.text_type(value)
+
+    changed = []
+    for field, value in six.iteritems(data):
+        if field == "project_id":
+            continue
+        custom = re.match(r"custom_(data|label|type)(\d+)$", field)
+        if custom:
+            current_value = (current.get("custom_field" + custom.group(2)) or {}).get(custom.group(1))
+        else:
+            current_value = current.get(field)
+        if _normalize(value) != _normalize(current_value):
+            changed.append(field)
+    return sorted(changed)
+
+def _security_ids(security, base_url, **conn_args):
+    """
+    Translate the users, groups and manager names of a password security to TPM ids.
+    Return None if a permission or a name is wrong.
+    """
+    security = dict(security)
+    if "users_permissions" in security:
+        if not _check_tpm_permission(list(security["users_permissions"].values()), "password"):
+            return None
+        security["users_permissions"] = _get_users_permissions_ids(security["users_permissions"], base_url, **conn_args)
+    if "groups_permissions" in security:
+        if not _check_tpm_permission(list(security["groups_permissions"].values()), "password"):
+            return None
+        security["groups_permissions"] = _get_groups_permissions_ids(security["groups_permissions"], base_url, **conn_args)
+    if "managed_by" in security:
+        retrieved_user = __salt__["teampass.get_user_by"]("name", security["managed_by"], base_url, **conn_args)
+        if len(retrieved_user) != 1:
+            return None
+        security["managed_by"] = retrieved_user[0]["id"]
+    return security
+
+def managed_passwords(name, base_url, passwords, concurrency=4, **conn_args):
+    """
+    Make the passwords of a project match a declared set, typically from pillar.
+    name
+        The name of the project holding the passwords
+    base_url
+        The host/address of the TPM
+    passwords
+        Desired passwords by name:
+          db-root:
+            data:                  # fields of create/update password
+              username: root
+              password: secret
+              tags: db,root
+              custom_data1: value
+            custom_fields:         # custom field labels and types
+              custom_label1: Port
+              custom_type1: Text
+            security:              # sent when it differs from the last one sent, a PUT replaces the ACL
+              users_permissions: {"John": 20}
+              groups_permissions: {"DBA": 30}
+              managed_by: John
+    concurrency
+        Number of passwords read or changed at the same time (default 4)
+    **conn_args :(Method: 1)  For HTTP Basic Authentication pass conn_args as username and password
+                 (Method: 2)  For HMAC Authentication pass conn_args as private_key and public_key
+
+    The passwords of the project are listed once, existing passwords are read concurrently,
+    and only the passwords whose fields differ are created or updated.
+    The declared security is only sent to new passwords, and to existing ones when it differs
+    from the security last sent by this minion (see _security_is_current).
+    Passwords of the project that are not declared are left untouched.
+    """
+
+    ret = {"name": name, "changes": {}, "result": False, "comment": ""}
+
+    project_search = _resolve_projects(name, base_url, **conn_args)
+    if len(project_search) != 1:
+       return _load_result(ret, "Project", name)
+    project_id = project_search[0]["id"]
+
+    existing = {}
+    for password_name in passwords:
+        matches = _resolve_passwords(password_name, name, base_url, **conn_args)
+        if len(matches) > 1:
+           ret["comment"] = "Password name " + password_name + " is not unique in project " + name
+           return ret
+        if matches:
+           existing[password_name] = matches[0]["id"]
+
+    records = __salt__["teampass.show_passwords_many"](base_url, list(existing.values()), concurrency, **conn_args)
+    current = dict((password_name, records[password_id]) for password_name, password_id in six.iteritems(existing))
+
+    security_dir = os.path.join(__opts__["cachedir"], "teampass", "security")
+    plan = []
+    errors = {}
+    for password_name in sorted(passwords):
+        spec = passwords[password_name] or {}
+        data = dict(spec.get("data") or {})
+        custom_fields = dict(spec.get("custom_fields") or {})
+        security = None
+        if spec.get("security"):
+           security = _security_ids(spec["security"], base_url, **conn_args)
+           if security is None:
+              errors[password_name] = {"error": "Wrong permission, user or group in security"}
+              continue
+        if password_name not in existing:
+           plan.append(("create", password_name, data, custom_fields, security))
+           continue
+        changed = _password_diff(data, current[password_name]) + _password_diff(custom_fields, current[password_name])
+        data = dict((field, data[field]) for field in data if field in changed)
+        custom_fields = dict((field, custom_fields[field]) for field in custom_fields if field in changed)
+        if security is not None and \
+           _security_is_current(_security_file(security_dir, base_url, "password", existing[password_name]), security):
+           security = None
+        if changed or security is not None:
+           plan.append(("update", password_name, data, custom_fields, security))
+
+    if not plan and not errors:
+       ret["result"] = True
+       ret["comment"] = "All passwords of project " + name + " are in the correct state"
+       return ret
+
+    if __opts__["test"]:
+       for action, password_name, data, custom_fields, security in plan:
+           ret["changes"][password_name] = {"action": action, "fields": sorted(list(data) + list(custom_fields))}
+           if security is not None:
+              ret["changes"][password_name]["security"] = "updated"
+       ret["changes"].update(errors)
+       ret["result"] = None
+       ret["comment"] = str(len(ret["changes"])) + " passwords of project " + name + " would be changed"
+       return ret
+
+    # Loader functions are looked up here, worker threads do not see __salt__ on Salt 3003+
+    create_password = __salt__["teampass.create_password"]
+    update_password = __salt__["teampass.update_password"]
+    update_custom_fields = __salt__["teampass.update_custom_fields_of_password"]
+    update_security = __salt__["teampass.update_security_of_password"]
+
+    def _apply(item):
+        action, password_name, data, custom_fields, security = item
+        changes = {"action": action, "fields": sorted(list(data) + list(custom_fields))}
+        try:
+            if action == "create":
+               data["project_id"] = project_id
+               password_id = create_password(password_name, base_url, data, **conn_args)
+               changes["id"] = password_id
+            else:
+               password_id = existing[password_name]
+               if data:
+                  update_password(password_name, base_url, password_id, data, **conn_args)
+            if custom_fields:
+               update_custom_fields(base_url, password_id, custom_fields, **conn_args)
+            if security is not None:
+               security_file = _security_file(security_dir, base_url, "password", password_id)
+               if _apply_security(update_security, security_file, password_id, security, base_url, conn_args):
+                  changes["security"] = "updated"
+        except CommandExecutionError as err:
+            changes["error"] = str(err)
+        return password_name, changes
+
+    pool = ThreadPool(max(1, min(int(concurrency), len(plan) or 1)))
+    try:
+        results = pool.map(_apply, plan)
+    finally:
+        pool.close()
+        pool.join()
+
+    results.extend(sorted(errors.items()))
+
+    _invalidate_resolver(base_url, conn_args, name)
+
+    failed = []
+    for password_name, changes in results:
+        ret["changes"][password_name] = changes
+        if "error" in changes:
+           failed.append(password_name)
+
+    if failed:
+       ret["comment"] = "Failed to manage passwords: " + ", ".join(failed)
+    else:
+       ret["result"] = True
+       ret["comment"] = str(len(results)) + " passwords of project " + name + " were changed"
+
+    return ret
+
 def create_user(name, base_url, data, **conn_args):
     ret = {"name": name, "changes": {}, "result": False, "comment": ""}
     if __opts__["test"]:
@@ -1227,6 +1531,91 @@ def delete_user_from_group(name, group_name, base_url, **conn_args):
 
     return ret
 
+def group_members(name, base_url, members, field="name", concurrency=4, **conn_args):
+    """
+    Make the members of a group match a desired list of users.
+    name
+        The name of the group
+    base_url
+        The host/address of the TPM
+    members
+        List of the users who must be members of the group
+    field
+        User field members are given by: name (default), username or email
+    concurrency
+        Number of membership changes sent at the same time (default 4)
+    **conn_args :(Method: 1)  For HTTP Basic Authentication pass conn_args as username and password
+                 (Method: 2)  For HMAC Authentication pass conn_args as private_key and public_key
+
+    The current membership is read once with show_group, and only the missing users
+    are added and the extra users are deleted.
+    """
+    ret = {"name": name, "changes": {}, "result": False, "comment": ""}
+
+    retrieved_group = __salt__["teampass.get_group_by"]("name", name, base_url, **conn_args)
+    if len(retrieved_group) != 1:
+       return _load_result(ret, "Group", name)
+    group_id = retrieved_group[0]["id"]
+
+    desired = {}
+    for member in set(members):
+        retrieved_user = __salt__["teampass.get_user_by"](field, member, base_url, **conn_args)
+        if len(retrieved_user) != 1:
+           return _load_result(ret, "User", member)
+        desired[retrieved_user[0]["id"]] = member
+
+    group = __salt__["teampass.show_group"](base_url, group_id, cached=False, **conn_args)
+    current = dict((user["id"], user.get(field if field != "email" else "email_address")) for user in group.get("users") or [])
+
+    to_add = sorted(set(desired) - set(current))
+    to_delete = sorted(set(current) - set(desired))
+
+    if not to_add and not to_delete:
+       ret["result"] = True
+       ret["comment"] = "Group " + name + " members are already in the correct state"
+       return ret
+
+    changes = {}
+    if to_add:
+       changes["added"] = sorted(desired[user_id] for user_id in to_add)
+    if to_delete:
+       changes["deleted"] = sorted(six.text_type(current[user_id]) for user_id in to_delete)
+
+    if __opts__["test"]:
+       ret["result"] = None
+       ret["changes"] = changes
+       ret["comment"] = "Group " + name + " members would be changed"
+       return ret
+
+    def _apply(item):
+        action, user_id = item
+        try:
+            action(base_url, group_id, user_id, **conn_args)
+        except CommandExecutionError as err:
+            return str(err)
+        return None
+
+    # Loader functions are looked up here, worker threads do not see __salt__ on Salt 3003+
+    add_user = __salt__["teampass.add_user_to_group"]
+    delete_user = __salt__["teampass.delete_user_from_group"]
+    plan = [(add_user, user_id) for user_id in to_add] + \
+           [(delete_user, user_id) for user_id in to_delete]
+    pool = ThreadPool(max(1, min(int(concurrency), len(plan))))
+    try:
+        errors = [error for error in pool.map(_apply, plan) if error]
+    finally:
+        pool.close()
+        pool.join()
+
+    ret["changes"] = changes
+    if errors:
+       ret["comment"] = "Failed to change members of group " + name + ": " + "; ".join(errors)
+    else:
+       ret["result"] = True
+       ret["comment"] = "Group " + name + " members were successfully changed"
+
+    return ret
+
 def delete_group(name, base_url, **conn_args):
     ret = {"name": name, "changes": {}, "result": False, "comment": ""}
     if __opts__["test"]: